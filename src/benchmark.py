@@ -0,0 +1,166 @@
+""" Throughput benchmark of the RNN cells on synthetic data.
+
+Every configuration runs in its own subprocess, so the reported peak RSS and
+graph build time are not polluted by the configurations before it. Results are
+written as JSON to --output.
+
+  python benchmark.py --cell_types SNGRU LNGRU --hidden 50 256 --output bench.json
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+
+# same as models.CELL_TYPES; importing models here would load tensorflow in the parent
+CELL_TYPES = ['SNGRU', 'LSTM', 'GRU', 'BasicRNN', 'LNGRU', 'LNLSTM', 'HyperLnLSTMCell']
+
+
+def peak_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    if platform.system() == 'Darwin':
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+def time_runs(sess, fetch, feed, iterations, warmup):
+    for _ in range(warmup):
+        sess.run(fetch, feed_dict=feed)
+    start = time.time()
+    for _ in range(iterations):
+        sess.run(fetch, feed_dict=feed)
+    return iterations / (time.time() - start)
+
+
+def run_config(config):
+    """ Builds and times one configuration; meant to run in a fresh process """
+    import numpy as np
+    import tensorflow as tf
+    import models
+    import streaming
+
+    streaming.storage_dtype = getattr(tf, config['stream_dtype'])
+    streaming.kahan_compensation = config['stream_kahan']
+
+    n_input = config['n_input']
+    n_steps = config['n_steps']
+    batch_size = config['batch_size']
+    n_hidden = config['hidden']
+    n_classes = 10
+
+    build_start = time.time()
+    x = tf.placeholder(tf.float32, [None, n_steps, n_input], name='x-input')
+    y = tf.placeholder(tf.float32, [None, n_classes], name='y-input')
+    weights = {
+        'out': tf.get_variable('weights', shape=[n_hidden, n_classes], initializer=tf.random_normal_initializer())
+    }
+    biases = {
+        'out': tf.get_variable('biases', shape=[n_classes], initializer=tf.random_normal_initializer())
+    }
+    cell = models.build_cell(config['cell_type'], n_hidden, config['layers'],
+                             stat_bank=config['stat_bank'], fused_matmul=config['fused_matmul'])
+    optimizer = streaming.StreamingOptimizer(tf.train.AdamOptimizer())
+    cost_fn = lambda logits: tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits, y))
+    if config['recompute_segment'] > 0:
+        pred, cost, grads, _ = models.checkpointed_rnn(x, cell, weights, biases, cost_fn,
+                                                       config['recompute_segment'])
+        train_step = optimizer.apply_gradients(grads)
+    else:
+        pred = models.rnn_logits(x, cell, weights, biases, dynamic=config['dynamic'])
+        train_step = optimizer.minimize(cost_fn(pred))
+    build_time = time.time() - build_start
+    op_count = len(tf.get_default_graph().get_operations())
+    # bytes of all streaming buffers (StatBanks included), compensation included
+    buffers = [v for side in streaming.streaming_sites() for v in side]
+    buffers += [c for comps in streaming.site_compensations() for c in comps if c is not None]
+    streaming_bytes = sum(v.get_shape().num_elements() * v.dtype.base_dtype.size for v in buffers)
+
+    rng = np.random.RandomState(0)
+    feed = {
+        x: rng.rand(batch_size, n_steps, n_input).astype(np.float32),
+        y: np.eye(n_classes, dtype=np.float32)[rng.randint(0, n_classes, batch_size)],
+    }
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        forward = time_runs(sess, pred, feed, config['iterations'], config['warmup'])
+        forward_backward = time_runs(sess, train_step, feed, config['iterations'], config['warmup'])
+
+    result = dict(config)
+    result.update({
+        'tf_version': tf.__version__,
+        'build_time_s': build_time,
+        'op_count': op_count,
+        'streaming_state_mb': streaming_bytes / (1024.0 * 1024.0),
+        'forward_steps_per_s': forward,
+        'forward_backward_steps_per_s': forward_backward,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the RNN cells on synthetic data.')
+    parser.add_argument('--cell_types', nargs='+', choices=CELL_TYPES, default=CELL_TYPES)
+    parser.add_argument('--hidden', nargs='+', type=int, default=[50, 256])
+    parser.add_argument('--layers', nargs='+', type=int, default=[1, 3])
+    parser.add_argument('--batch_size', nargs='+', type=int, default=[32, 128])
+    parser.add_argument('--n_steps', nargs='+', type=int, default=[28, 100])
+    parser.add_argument('--n_input', type=int, default=28)
+    parser.add_argument('--iterations', help='timed runs per measurement', type=int, default=20)
+    parser.add_argument('--warmup', help='untimed runs per measurement', type=int, default=3)
+    parser.add_argument('--dynamic', help='build with dynamic_rnn instead of unrolling', action='store_true')
+    parser.add_argument('--recompute_segment', help='steps per recomputed segment (0: no recomputation); '
+                        'compare peak_rss_mb and steps/s across values', nargs='+', type=int, default=[0])
+    parser.add_argument('--fused_matmul', help='SNGRU/LNGRU: 1 for one input (precomputed for all steps) and one '
+                        'state matmul, 0 for four per step; compare op_count and steps/s',
+                        nargs='+', type=int, choices=[0, 1], default=[0])
+    parser.add_argument('--stat_bank', help='SNGRU: 1 to stream all statistics of the model through one StatBank, '
+                        '0 for one set of variables per site; compare op_count and steps/s',
+                        nargs='+', type=int, choices=[0, 1], default=[0])
+    parser.add_argument('--stream_dtype', help='storage dtype of the streaming buffers',
+                        choices=['float32', 'float16', 'bfloat16'], default='float32')
+    parser.add_argument('--stream_kahan', help='compensate the rounding of narrow streaming buffers; does not save memory over float32', action='store_true')
+    parser.add_argument('--output', help='JSON results file', default='bench_results.json')
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.config:
+        # child process: run a single configuration and print its result
+        print(json.dumps(run_config(json.loads(args.config))))
+        return
+
+    results = []
+    grid = itertools.product(args.cell_types, args.hidden, args.layers, args.batch_size, args.n_steps,
+                             args.recompute_segment, args.fused_matmul, args.stat_bank)
+    for cell_type, hidden, layers, batch_size, n_steps, recompute_segment, fused_matmul, stat_bank in grid:
+        config = {
+            'cell_type': cell_type, 'hidden': hidden, 'layers': layers,
+            'batch_size': batch_size, 'n_steps': n_steps, 'n_input': args.n_input,
+            'recompute_segment': recompute_segment, 'fused_matmul': bool(fused_matmul),
+            'stat_bank': bool(stat_bank),
+            'iterations': args.iterations, 'warmup': args.warmup, 'dynamic': args.dynamic,
+            'stream_dtype': args.stream_dtype, 'stream_kahan': args.stream_kahan,
+        }
+        proc = subprocess.Popen([sys.executable, __file__, '--config', json.dumps(config)],
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0].decode('utf-8')
+        if proc.returncode != 0:
+            result = dict(config, error='exit code %d' % proc.returncode)
+        else:
+            # the result is the last line; tensorflow may print before it
+            result = json.loads(out.strip().splitlines()[-1])
+        results.append(result)
+        print('%s' % json.dumps(result))
+
+    with open(args.output, 'w') as f:
+        json.dump({'host': platform.node(), 'time': time.time(), 'results': results}, f, indent=1)
+    print('Wrote %d results to %s' % (len(results), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+""" Precision and memory of the streaming buffers in each storage mode.
+
+Replays the forward side of one streaming site (update_streaming with the
+ALPHA/kappa of streaming.stream) in NumPy, with the buffers stored as the
+graph stores them: float32, float16, or float16 plus a float16 compensation
+buffer (streaming.kahan_compensation). The arithmetic is float32 as in the
+graph, rounding only on stores. Reports the largest error of the final
+statistic against a float64 replay and the bytes per feature of the four
+activation-shaped buffers (long, short, short_m2, final, plus compensation).
+
+  python check_precision.py --window 28 --windows 50
+  python check_precision.py --window 2000 --windows 1
+
+Only the storage is emulated here; the accuracy of a trained model is
+compared with mnist.py --stream_dtype float16 [--stream_kahan].
+"""
+
+import argparse
+
+import numpy as np
+
+MODES = [('float32', np.float32, False), ('float16', np.float16, False), ('float16+comp', np.float16, True)]
+N_BUFFERS = 4
+
+
+class _Buffer(object):
+    # one streaming buffer in the storage dtype, with its optional compensation
+    def __init__(self, shape, dtype, compensated):
+        self.value = np.zeros(shape, dtype=dtype)
+        self.comp = np.zeros(shape, dtype=dtype) if compensated and dtype != np.float32 else None
+
+    def read(self):
+        value = self.value.astype(np.float32)
+        if self.comp is not None:
+            value += self.comp.astype(np.float32)
+        return value
+
+    def store(self, value):
+        self.value[...] = value
+        if self.comp is not None:
+            self.comp[...] = value - self.value.astype(np.float32)
+
+    def nbytes(self):
+        return self.value.nbytes + (self.comp.nbytes if self.comp is not None else 0)
+
+
+def replay(windows, dtype, compensated, compute_dtype=np.float32):
+    """ Streams every window (of shape [steps] + feature shape) with a weight
+    update before each; returns the final statistic after every step and the
+    bytes of the buffers """
+    shape = windows[0].shape[1:]
+    long_val, short, m2, final = [_Buffer(shape, dtype, compensated) for _ in range(N_BUFFERS)]
+    counter = compute_dtype(0)
+    finals = []
+    for window in windows:
+        # the flag was raised: fold the short window into long and start anew
+        long_val.store(short.read())
+        mean = np.zeros(shape, dtype=compute_dtype)
+        m2_val = np.zeros(shape, dtype=compute_dtype)
+        counter = compute_dtype(0)
+        for x in window.astype(compute_dtype):
+            counter += 1
+            delta = x - mean
+            mean = mean + delta / counter
+            m2_val = m2_val + delta * (x - mean)
+            short.store(mean)
+            m2.store(m2_val)
+            # final = long*ALPHA[0] + mean*ALPHA[1]
+            final.store(mean)
+            finals.append(final.read().astype(np.float64))
+            mean = short.read().astype(compute_dtype)
+            m2_val = m2.read().astype(compute_dtype)
+    nbytes = sum(b.nbytes() for b in (long_val, short, m2, final))
+    return np.array(finals), nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precision and memory of the streaming buffers per storage mode.')
+    parser.add_argument('--window', help='# steps between weight updates', type=int, default=28)
+    parser.add_argument('--windows', help='# weight updates', type=int, default=50)
+    parser.add_argument('--features', help='# features of the site', type=int, default=1024)
+    parser.add_argument('--mean', help='mean of the inputs', type=float, default=3.0)
+    parser.add_argument('--std', help='standard deviation of the inputs', type=float, default=0.5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    windows = [args.mean + args.std * rng.randn(args.window, args.features) for _ in range(args.windows)]
+    reference, _ = replay(windows, np.float64, False, compute_dtype=np.float64)
+    print('%d windows of %d steps, inputs N(%g, %g)' % (args.windows, args.window, args.mean, args.std))
+    for name, dtype, compensated in MODES:
+        finals, nbytes = replay(windows, dtype, compensated)
+        error = np.abs(finals - reference)
+        print('%-13s max error %.2e  mean error %.2e  %d bytes/feature' % (
+            name, error.max(), error.mean(), nbytes // args.features))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+""" Checkpoints of the weights and the streaming state, saved incrementally.
+
+A checkpoint is a directory holding `manifest.json` and chunk files. Every
+save writes only the tensors whose contents changed since the last save, as
+raw arrays in one uncompressed .npz chunk, so values come back bit-exact;
+the manifest maps every variable name to the chunk holding its latest value.
+Chunks no longer referenced are deleted once the new manifest is in place.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+import streaming
+
+MANIFEST = 'manifest.json'
+
+
+def inference_variables(graph=None):
+    """ The weights and the frozen streaming statistics, all an inference graph needs """
+    graph = graph or tf.get_default_graph()
+    return graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) + streaming.frozen_statistics(graph)
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _digest(value):
+    return hashlib.md5(np.ascontiguousarray(value).view(np.uint8)).hexdigest()
+
+
+def _assign_op(variables):
+    placeholders = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in variables]
+    return placeholders, tf.group(*[v.assign(p) for v, p in zip(variables, placeholders)])
+
+
+class Checkpointer(object):
+    """Saves var_list (all global variables by default) into a directory.
+
+    The values are fetched on the calling thread; hashing and writing happen on
+    a background thread, so training continues while a checkpoint is written.
+    Saving into a directory that already holds a checkpoint continues it
+    incrementally. Every `full_every`-th save writes all tensors into one fresh
+    chunk, so the chunks of older saves can be dropped.
+    """
+
+    def __init__(self, directory, var_list=None, full_every=0):
+        self._directory = directory
+        self._variables = var_list if var_list is not None else tf.global_variables()
+        self._full_every = full_every
+        self._saves = 0
+        self._thread = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        manifest = read_manifest(directory)
+        self._tensors = manifest['tensors'] if manifest else {}
+        self._chunk = manifest['chunk'] if manifest else 0
+
+    def save(self, sess, step, extra=None):
+        """ Snapshots the variables and writes them in the background; returns at once """
+        values = sess.run(self._variables)
+        # one write at a time, in order
+        self.wait()
+        full = self._full_every > 0 and self._saves % self._full_every == 0
+        self._saves += 1
+        self._thread = threading.Thread(target=self._write, args=(values, step, extra or {}, full))
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _write(self, values, step, extra, full):
+        changed = {}
+        tensors = {}
+        for variable, value in zip(self._variables, values):
+            digest = _digest(value)
+            entry = self._tensors.get(variable.name)
+            if not full and entry is not None and entry['digest'] == digest:
+                tensors[variable.name] = entry
+                continue
+            key = 't%d' % len(changed)
+            changed[key] = value
+            tensors[variable.name] = {'key': key, 'digest': digest}
+
+        self._chunk += 1
+        chunk = 'chunk-%06d.npz' % self._chunk
+        if changed:
+            np.savez(os.path.join(self._directory, chunk), **changed)
+            for entry in tensors.values():
+                entry.setdefault('file', chunk)
+
+        manifest = {'step': step, 'chunk': self._chunk, 'tensors': tensors, 'extra': extra}
+        tmp = os.path.join(self._directory, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        # the rename is atomic, so a crash leaves the previous checkpoint intact
+        os.rename(tmp, os.path.join(self._directory, MANIFEST))
+        self._tensors = tensors
+
+        used = set(entry['file'] for entry in tensors.values())
+        for name in os.listdir(self._directory):
+            if name.startswith('chunk-') and name not in used:
+                os.remove(os.path.join(self._directory, name))
+
+
+class AsyncRestore(object):
+    """Reads a checkpoint on a background thread, started on construction.
+
+    Create it as early as possible (e.g. right after parsing the arguments),
+    so reading overlaps with building the graph; `restore` then only waits
+    for what is left and assigns the values.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._values = None
+        self._manifest = None
+        self._error = None
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        try:
+            manifest = read_manifest(self._directory)
+            values = {}
+            if manifest is not None:
+                chunks = {}
+                for name, entry in manifest['tensors'].items():
+                    if entry['file'] not in chunks:
+                        chunks[entry['file']] = np.load(os.path.join(self._directory, entry['file']))
+                    values[name] = chunks[entry['file']][entry['key']]
+            self._manifest = manifest
+            self._values = values
+        except Exception as e:
+            self._error = e
+
+    def restore(self, sess, var_list=None):
+        """Assigns the saved values to var_list (all global variables by default).
+
+        Returns the manifest (with 'step' and 'extra'), or None if there is no
+        checkpoint. Variables missing from the checkpoint keep their values.
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if self._manifest is None:
+            return None
+        variables = var_list if var_list is not None else tf.global_variables()
+        found = [v for v in variables if v.name in self._values]
+        missing = [v.name for v in variables if v.name not in self._values]
+        if missing:
+            print('Not in checkpoint, left as initialized: ' + ', '.join(missing))
+        placeholders, assign = _assign_op(found)
+        sess.run(assign, feed_dict=dict((p, self._values[v.name]) for p, v in zip(placeholders, found)))
+        return self._manifest
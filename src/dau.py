@@ -0,0 +1,31 @@
+""" In-graph gradient accumulation for decoupled accumulation and update (DAU) """
+
+import tensorflow as tf
+
+
+def accumulate_gradients(optimizer, grads_and_vars, n_dau, name='dau'):
+    """Builds the ops to sum gradients over n_dau batches and apply their mean.
+
+    The running sums live in non-trainable variables next to the weights, so the
+    gradients never leave the runtime.
+
+    Returns:
+      accumulate: op adding the gradients of the fed batch to the sums.
+      apply_and_reset: op applying the mean of the sums with `optimizer` and
+        zeroing them afterwards.
+    """
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    with tf.name_scope(name):
+        accums = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                              trainable=False, name=v.op.name.replace('/', '_'))
+                  for g, v in grads_and_vars]
+        accumulate = tf.group(*[a.assign_add(g) for a, (g, v) in zip(accums, grads_and_vars)],
+                              name='accumulate')
+
+        apply_grads = optimizer.apply_gradients(
+            [(a / float(n_dau), v) for a, (g, v) in zip(accums, grads_and_vars)])
+        # the sums are read by apply_grads, so only zero them afterwards
+        with tf.control_dependencies([apply_grads]):
+            reset = [a.assign(tf.zeros_like(a)) for a in accums]
+        apply_and_reset = tf.group(*reset, name='apply_and_reset')
+    return accumulate, apply_and_reset
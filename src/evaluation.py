@@ -0,0 +1,101 @@
+""" Evaluation over a whole dataset in fixed-size chunks, optionally on a background thread """
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import tensorflow as tf
+
+
+def eval_sums(logits, labels):
+    """ Number of correct predictions and summed loss of a chunk, to be accumulated over chunks """
+    correct = tf.equal(tf.argmax(logits, 1), tf.argmax(labels, 1))
+    correct_sum = tf.reduce_sum(tf.cast(correct, tf.float32))
+    loss_sum = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(logits, labels))
+    return correct_sum, loss_sum
+
+
+def evaluate(sess, sums, x, y, images, labels, chunk_size=1000):
+    """Runs sums (from eval_sums) over all images in chunks of chunk_size.
+
+    Returns the accuracy and mean loss over the whole set; the last chunk
+    may be smaller.
+    """
+    correct_sum, loss_sum = sums
+    x_shape = [-1] + x.get_shape().as_list()[1:]
+    correct = 0.0
+    loss = 0.0
+    for start in range(0, len(images), chunk_size):
+        chunk_x = images[start:start + chunk_size].reshape(x_shape)
+        chunk_y = labels[start:start + chunk_size]
+        c, l = sess.run([correct_sum, loss_sum], feed_dict={x: chunk_x, y: chunk_y})
+        correct += c
+        loss += l
+    return correct / len(images), loss / len(images)
+
+
+class BackgroundEvaluator(object):
+    """Evaluates snapshots of the weights on a thread, in a graph of its own.
+
+    build_fn(x, y) builds the inference model in that graph and returns its
+    eval_sums. `submit` copies source_vars (e.g. checkpoint.inference_variables())
+    on the calling thread and returns at once; their values are assigned to
+    the variables of the same name in the evaluation graph, so training can go
+    on changing the originals. If a snapshot is still waiting when the next is
+    submitted, the older one is dropped. `callback(step, accuracy, loss)` is
+    called on the evaluation thread.
+    """
+
+    def __init__(self, build_fn, x_shape, n_classes, images, labels, source_vars,
+                 callback, chunk_size=1000):
+        self._images = images
+        self._labels = labels
+        self._chunk_size = chunk_size
+        self._source_vars = source_vars
+        self._callback = callback
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._x = tf.placeholder(tf.float32, [None] + list(x_shape), name='x-eval')
+            self._y = tf.placeholder(tf.float32, [None, n_classes], name='y-eval')
+            self._sums = build_fn(self._x, self._y)
+            by_name = dict((v.name, v) for v in tf.global_variables())
+            targets = [by_name[v.name] for v in source_vars]
+            self._inputs = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in targets]
+            self._assign = tf.group(*[v.assign(p) for v, p in zip(targets, self._inputs)])
+            self._sess = tf.Session()
+            self._sess.run(tf.global_variables_initializer())
+        self._graph.finalize()
+
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, sess, step):
+        values = sess.run(self._source_vars)
+        try:
+            self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._queue.put((step, values))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            step, values = item
+            self._sess.run(self._assign, feed_dict=dict(zip(self._inputs, values)))
+            acc, loss = evaluate(self._sess, self._sums, self._x, self._y,
+                                 self._images, self._labels, self._chunk_size)
+            self._callback(step, acc, loss)
+
+    def stop(self):
+        """ Waits for the last submitted snapshot to be evaluated """
+        self._queue.put(None)
+        self._thread.join()
+        self._sess.close()
@@ -12,22 +12,85 @@ else:
     rnn_cell = tf.nn.rnn_cell
 
 
-def sn(input, s, b, epsilon=1e-5, max=1000, name='snorm'):
-    """ Streaming normalizes a 2D tensor along its 1st axis, which corresponds to batch """
+def sn(input, s, b, epsilon=1e-5, max=1000, name='snorm', fused=True, training_mode=True):
+    """ Streaming normalizes a 2D tensor along its 1st axis, which corresponds to batch.
+    With training_mode=False the frozen streaming statistics are used and nothing is updated. """
+    if not fused:
+        m, v = tf.nn.moments(input, [0], keep_dims=True)
+        v_sqrt = tf.sqrt(v + epsilon)
+        m_stream = streaming.stream(m, name + 'sm', training_mode)
+        v_sqrt_stream = streaming.stream(v_sqrt, name + 'sv', training_mode)
+        normalised_input = (input - m_stream) / v_sqrt_stream
+        return normalised_input * s + b
+
+    # stream mean and std together as one [2, n] statistic, so both share a
+    # single set of streaming variables and a single update chain; their
+    # counter and flag are the same as the separate ones would be, and each
+    # row checks for its first update of long on its own
+    n = input.get_shape()[1].value
+    stats_stream = streaming.stream(sn_stats(input, epsilon), name + 's', training_mode, blocks=[n])
+    return sn_apply(input, stats_stream, s, b)
+
+
+def sn_stats(input, epsilon=1e-5):
+    """ Batch mean and std of a 2D tensor, stacked as a [2, n] statistic """
     m, v = tf.nn.moments(input, [0], keep_dims=True)
-    v_sqrt = tf.sqrt(v + epsilon)
-    m_stream = streaming.stream(m, name + 'sm')
-    v_sqrt_stream = streaming.stream(v_sqrt, name + 'sv')
-    normalised_input = (input - m_stream) / v_sqrt_stream
-    return normalised_input * s + b
+    return tf.concat(0, [m, tf.sqrt(v + epsilon)])
+
+
+def sn_apply(input, stats, s, b):
+    """ Normalizes a 2D tensor with [2, n] (streamed) mean and std statistics """
+    m_stream, v_sqrt_stream = tf.split(0, 2, stats)
+    # fold the normalization into one scale and shift on the [1, n] statistics,
+    # so the activation tensor is only touched by a single multiply-add
+    scale = s / v_sqrt_stream
+    shift = b - m_stream * scale
+    return input * scale + shift
+
+
+def _gru_linear(input, dim, scope):
+    """ One matmul to 3 * dim, sliced into the [2 * dim] gate and [dim] candidate parts """
+    return _gru_split(rnn_cell._linear([input], 3 * dim, False, scope=scope), dim)
+
+
+def _gru_split(out, dim):
+    return tf.slice(out, [0, 0], [-1, 2 * dim]), tf.slice(out, [0, 2 * dim], [-1, dim])
+
+
+def project_gru_inputs(inputs, num_units, scope="in_proj"):
+    """ The fused input projection of a GRU cell built with input_projected=True,
+    done outside the cell: one [rows, input] x [input, 3 * num_units] matmul,
+    e.g. over the inputs of all timesteps at once """
+    return rnn_cell._linear([inputs], 3 * num_units, False, scope=scope)
 
 
 class SNGRUCell(rnn_cell.RNNCell):
-    def __init__(self, num_units, input_size=None, activation=tf.tanh):
+    def __init__(self, num_units, input_size=None, activation=tf.tanh, training_mode=True,
+        stat_bank=False, fused_matmul=False, input_projected=False, bank_slot=0):
+        """
+        Args:
+          stat_bank: A streaming.StatBank (e.g. shared by all layers of a model,
+            see models.build_cell), or True for one of the cell's own. The
+            streaming statistics of all four normalization sites are packed
+            into slot bank_slot of it and updated by a single chain per step,
+            instead of one set of streaming variables per site.
+          fused_matmul: If True, the gate and candidate projections are done by
+            one input and one state matmul to 3 * num_units each.
+          input_projected: With fused_matmul, the inputs come already projected
+            to 3 * num_units by project_gru_inputs (e.g. for all timesteps in
+            one matmul), so the cell only does the state matmul.
+        """
         if input_size is not None:
             print("%s: The input_size parameter is deprecated." % self)
         self._num_units = num_units
         self._activation = activation
+        self._training_mode = training_mode
+        if stat_bank is True:
+            stat_bank = streaming.StatBank(1)
+        self._stat_bank = stat_bank or None
+        self._bank_slot = bank_slot
+        self._fused_matmul = fused_matmul
+        self._input_projected = input_projected
 
     @property
     def state_size(self):
@@ -45,42 +108,64 @@ class SNGRUCell(rnn_cell.RNNCell):
                 # We start with bias of 1.0 to not reset and not update.
                 with tf.variable_scope("Layer_Parameters"):
 
-                    s1 = tf.get_variable("s1", initializer=tf.ones(
-                        [2 * dim]), dtype=tf.float32)
-                    s2 = tf.get_variable("s2", initializer=tf.ones(
-                        [2 * dim]), dtype=tf.float32)
+                    s1 = tf.get_variable(
+                        "s1", shape=[2 * dim], initializer=tf.constant_initializer(1.0))
+                    s2 = tf.get_variable(
+                        "s2", shape=[2 * dim], initializer=tf.constant_initializer(1.0))
                     s3 = tf.get_variable(
-                        "s3", initializer=tf.ones([dim]), dtype=tf.float32)
+                        "s3", shape=[dim], initializer=tf.constant_initializer(1.0))
                     s4 = tf.get_variable(
-                        "s4", initializer=tf.ones([dim]), dtype=tf.float32)
-                    b1 = tf.get_variable("b1", initializer=tf.zeros(
-                        [2 * dim]), dtype=tf.float32)
-                    b2 = tf.get_variable("b2", initializer=tf.zeros(
-                        [2 * dim]), dtype=tf.float32)
+                        "s4", shape=[dim], initializer=tf.constant_initializer(1.0))
+                    b1 = tf.get_variable(
+                        "b1", shape=[2 * dim], initializer=tf.constant_initializer(0.0))
+                    b2 = tf.get_variable(
+                        "b2", shape=[2 * dim], initializer=tf.constant_initializer(0.0))
                     b3 = tf.get_variable(
-                        "b3", initializer=tf.zeros([dim]), dtype=tf.float32)
+                        "b3", shape=[dim], initializer=tf.constant_initializer(0.0))
                     b4 = tf.get_variable(
-                        "b4", initializer=tf.zeros([dim]), dtype=tf.float32)
-
-                input_below_ = rnn_cell._linear([inputs],
-                                                2 * self._num_units, False, scope="out_1")
-                input_below_ = sn(input_below_, s1, b1, name='g_in')
-                state_below_ = rnn_cell._linear([state],
-                                                2 * self._num_units, False, scope="out_2")
-                state_below_ = sn(state_below_, s2, b2, name='g_st')
-                out = tf.add(input_below_, state_below_)
-                r, u = tf.split(1, 2, out)
-                r, u = tf.sigmoid(r), tf.sigmoid(u)
-
-            with tf.variable_scope("Candidate"):
-                input_below_x = rnn_cell._linear([inputs],
-                                                 self._num_units, False, scope="out_3")
-                input_below_x = sn(input_below_x, s3, b3, name='c_in')
-                state_below_x = rnn_cell._linear([state],
-                                                 self._num_units, False, scope="out_4")
-                state_below_x = sn(state_below_x, s4, b4, name='c_st')
-                c_pre = tf.add(input_below_x, r * state_below_x)
-                c = self._activation(c_pre)
+                        "b4", shape=[dim], initializer=tf.constant_initializer(0.0))
+
+            if self._fused_matmul:
+                if self._input_projected:
+                    input_below_, input_below_x = _gru_split(inputs, dim)
+                else:
+                    input_below_, input_below_x = _gru_linear(inputs, dim, scope="in_proj")
+                state_below_, state_below_x = _gru_linear(state, dim, scope="st_proj")
+            else:
+                with tf.variable_scope("Gates"):
+                    input_below_ = rnn_cell._linear([inputs],
+                                                    2 * self._num_units, False, scope="out_1")
+                    state_below_ = rnn_cell._linear([state],
+                                                    2 * self._num_units, False, scope="out_2")
+
+                with tf.variable_scope("Candidate"):
+                    input_below_x = rnn_cell._linear([inputs],
+                                                     self._num_units, False, scope="out_3")
+                    state_below_x = rnn_cell._linear([state],
+                                                     self._num_units, False, scope="out_4")
+
+            if self._stat_bank is not None:
+                below = [input_below_, state_below_, input_below_x, state_below_x]
+                stats = streaming.stream_bank([sn_stats(t) for t in below], self._stat_bank, self._bank_slot,
+                                              self._training_mode)
+                input_below_ = sn_apply(input_below_, stats[0], s1, b1)
+                state_below_ = sn_apply(state_below_, stats[1], s2, b2)
+                input_below_x = sn_apply(input_below_x, stats[2], s3, b3)
+                state_below_x = sn_apply(state_below_x, stats[3], s4, b4)
+            else:
+                with tf.variable_scope("Gates"):
+                    input_below_ = sn(input_below_, s1, b1, name='g_in', training_mode=self._training_mode)
+                    state_below_ = sn(state_below_, s2, b2, name='g_st', training_mode=self._training_mode)
+                with tf.variable_scope("Candidate"):
+                    input_below_x = sn(input_below_x, s3, b3, name='c_in', training_mode=self._training_mode)
+                    state_below_x = sn(state_below_x, s4, b4, name='c_st', training_mode=self._training_mode)
+
+            out = tf.add(input_below_, state_below_)
+            r, u = tf.split(1, 2, out)
+            r, u = tf.sigmoid(r), tf.sigmoid(u)
+
+            c_pre = tf.add(input_below_x, r * state_below_x)
+            c = self._activation(c_pre)
             new_h = u * state + (1 - u) * c
         return new_h, new_h
 
@@ -92,13 +177,41 @@ def ln(input, s, b, epsilon=1e-5, max=1000):
     return normalised_input * s + b
 
 
+def ln_gates(input, s, b, n_gates=4, epsilon=1e-5):
+    """ Layer normalizes each of the n_gates blocks of a [batch, n_gates * units]
+    tensor on its own, with one moments pass over a [batch, n_gates, units] view """
+    units = input.get_shape()[1].value // n_gates
+    gates = tf.reshape(input, [-1, n_gates, units])
+    m, v = tf.nn.moments(gates, [2], keep_dims=True)
+    normalised_input = tf.reshape((gates - m) / tf.sqrt(v + epsilon), [-1, n_gates * units])
+    return normalised_input * s + b
+
+
+def _ln_lstm(input, s, b, per_gate):
+    # normalization of the concatenated i, j, f, o pre-activations
+    if per_gate:
+        return ln_gates(input, s, b)
+    return ln(input, s, b)
+
+
 class LNGRUCell(rnn_cell.RNNCell):
     """Gated Recurrent Unit cell (cf. http://arxiv.org/abs/1406.1078)."""
-    def __init__(self, num_units, input_size=None, activation=tf.tanh):
+    def __init__(self, num_units, input_size=None, activation=tf.tanh, fused_matmul=False,
+        input_projected=False):
+        """
+        Args:
+          fused_matmul: If True, the gate and candidate projections are done by
+            one input and one state matmul to 3 * num_units each.
+          input_projected: With fused_matmul, the inputs come already projected
+            to 3 * num_units by project_gru_inputs (e.g. for all timesteps in
+            one matmul), so the cell only does the state matmul.
+        """
         if input_size is not None:
             print("%s: The input_size parameter is deprecated." % self)
         self._num_units = num_units
         self._activation = activation
+        self._fused_matmul = fused_matmul
+        self._input_projected = input_projected
 
     @property
     def state_size(self):
@@ -116,22 +229,22 @@ class LNGRUCell(rnn_cell.RNNCell):
                 # We start with bias of 1.0 to not reset and not update.
                 with tf.variable_scope("Layer_Parameters"):
 
-                    s1 = tf.get_variable("s1", initializer=tf.ones(
-                        [2 * dim]), dtype=tf.float32)
-                    s2 = tf.get_variable("s2", initializer=tf.ones(
-                        [2 * dim]), dtype=tf.float32)
+                    s1 = tf.get_variable(
+                        "s1", shape=[2 * dim], initializer=tf.constant_initializer(1.0))
+                    s2 = tf.get_variable(
+                        "s2", shape=[2 * dim], initializer=tf.constant_initializer(1.0))
                     s3 = tf.get_variable(
-                        "s3", initializer=tf.ones([dim]), dtype=tf.float32)
+                        "s3", shape=[dim], initializer=tf.constant_initializer(1.0))
                     s4 = tf.get_variable(
-                        "s4", initializer=tf.ones([dim]), dtype=tf.float32)
-                    b1 = tf.get_variable("b1", initializer=tf.zeros(
-                        [2 * dim]), dtype=tf.float32)
-                    b2 = tf.get_variable("b2", initializer=tf.zeros(
-                        [2 * dim]), dtype=tf.float32)
+                        "s4", shape=[dim], initializer=tf.constant_initializer(1.0))
+                    b1 = tf.get_variable(
+                        "b1", shape=[2 * dim], initializer=tf.constant_initializer(0.0))
+                    b2 = tf.get_variable(
+                        "b2", shape=[2 * dim], initializer=tf.constant_initializer(0.0))
                     b3 = tf.get_variable(
-                        "b3", initializer=tf.zeros([dim]), dtype=tf.float32)
+                        "b3", shape=[dim], initializer=tf.constant_initializer(0.0))
                     b4 = tf.get_variable(
-                        "b4", initializer=tf.zeros([dim]), dtype=tf.float32)
+                        "b4", shape=[dim], initializer=tf.constant_initializer(0.0))
 
                     # Code below initialized for all cells
                     # s1 = tf.Variable(tf.ones([2 * dim]), name="s1")
@@ -143,26 +256,36 @@ class LNGRUCell(rnn_cell.RNNCell):
                     # b3 = tf.Variable(tf.zeros([dim]), name="b3")
                     # b4 = tf.Variable(tf.zeros([dim]), name="b4")
 
-                input_below_ = rnn_cell._linear([inputs],
-                                                2 * self._num_units, False, scope="out_1")
-                input_below_ = ln(input_below_, s1, b1)
-
-                state_below_ = rnn_cell._linear([state],
-                                                2 * self._num_units, False, scope="out_2")
-                state_below_ = ln(state_below_, s2, b2)
-                out = tf.add(input_below_, state_below_)
-                r, u = tf.split(1, 2, out)
-                r, u = tf.sigmoid(r), tf.sigmoid(u)
-
-            with tf.variable_scope("Candidate"):
-                input_below_x = rnn_cell._linear([inputs],
-                                                 self._num_units, False, scope="out_3")
-                input_below_x = ln(input_below_x, s3, b3)
-                state_below_x = rnn_cell._linear([state],
-                                                 self._num_units, False, scope="out_4")
-                state_below_x = ln(state_below_x, s4, b4)
-                c_pre = tf.add(input_below_x, r * state_below_x)
-                c = self._activation(c_pre)
+            if self._fused_matmul:
+                if self._input_projected:
+                    input_below_, input_below_x = _gru_split(inputs, dim)
+                else:
+                    input_below_, input_below_x = _gru_linear(inputs, dim, scope="in_proj")
+                state_below_, state_below_x = _gru_linear(state, dim, scope="st_proj")
+            else:
+                with tf.variable_scope("Gates"):
+                    input_below_ = rnn_cell._linear([inputs],
+                                                    2 * self._num_units, False, scope="out_1")
+                    state_below_ = rnn_cell._linear([state],
+                                                    2 * self._num_units, False, scope="out_2")
+
+                with tf.variable_scope("Candidate"):
+                    input_below_x = rnn_cell._linear([inputs],
+                                                     self._num_units, False, scope="out_3")
+                    state_below_x = rnn_cell._linear([state],
+                                                     self._num_units, False, scope="out_4")
+
+            # the gate and candidate slices keep their own normalization
+            input_below_ = ln(input_below_, s1, b1)
+            state_below_ = ln(state_below_, s2, b2)
+            out = tf.add(input_below_, state_below_)
+            r, u = tf.split(1, 2, out)
+            r, u = tf.sigmoid(r), tf.sigmoid(u)
+
+            input_below_x = ln(input_below_x, s3, b3)
+            state_below_x = ln(state_below_x, s4, b4)
+            c_pre = tf.add(input_below_x, r * state_below_x)
+            c = self._activation(c_pre)
             new_h = u * state + (1 - u) * c
         return new_h, new_h
 
@@ -188,16 +311,19 @@ class LNBasicLSTMCell(rnn_cell.RNNCell):
     """
 
     def __init__(self, num_units, forget_bias=1.0, input_size=None,
-        state_is_tuple=False, activation=tf.tanh):
+        state_is_tuple=True, activation=tf.tanh, per_gate_ln=False):
         """Initialize the basic LSTM cell.
         Args:
           num_units: int, The number of units in the LSTM cell.
           forget_bias: float, The bias added to forget gates (see above).
           input_size: Deprecated and unused.
-          state_is_tuple: If True, accepted and returned states are 2-tuples of
-            the `c_state` and `m_state`.  By default (False), they are concatenated
-            along the column axis.  This default behavior will soon be deprecated.
+          state_is_tuple: If True (default), accepted and returned states are
+            2-tuples of the `c_state` and `m_state`, passed through without
+            copies. If False, they are concatenated along the column axis; only
+            kept for compatibility.
           activation: Activation function of the inner states.
+          per_gate_ln: If True, each gate is layer normalized with its own
+            statistics instead of all four gates sharing them.
         """
         if not state_is_tuple:
             print("%s: Using a concatenated state is slower and will soon be "
@@ -208,6 +334,7 @@ class LNBasicLSTMCell(rnn_cell.RNNCell):
         self._forget_bias = forget_bias
         self._state_is_tuple = state_is_tuple
         self._activation = activation
+        self._per_gate_ln = per_gate_ln
 
     @property
     def state_size(self):
@@ -228,19 +355,19 @@ class LNBasicLSTMCell(rnn_cell.RNNCell):
             else:
                 c, h = tf.split(1, 2, state)
 
-            s1 = tf.get_variable("s1", initializer=tf.ones(
-                [4 * self._num_units]), dtype=tf.float32)
-            s2 = tf.get_variable("s2", initializer=tf.ones(
-                [4 * self._num_units]), dtype=tf.float32)
-            s3 = tf.get_variable("s3", initializer=tf.ones(
-                [self._num_units]), dtype=tf.float32)
+            s1 = tf.get_variable(
+                "s1", shape=[4 * self._num_units], initializer=tf.constant_initializer(1.0))
+            s2 = tf.get_variable(
+                "s2", shape=[4 * self._num_units], initializer=tf.constant_initializer(1.0))
+            s3 = tf.get_variable(
+                "s3", shape=[self._num_units], initializer=tf.constant_initializer(1.0))
 
-            b1 = tf.get_variable("b1", initializer=tf.zeros(
-                [4 * self._num_units]), dtype=tf.float32)
-            b2 = tf.get_variable("b2", initializer=tf.zeros(
-                [4 * self._num_units]), dtype=tf.float32)
-            b3 = tf.get_variable("b3", initializer=tf.zeros(
-                [self._num_units]), dtype=tf.float32)
+            b1 = tf.get_variable(
+                "b1", shape=[4 * self._num_units], initializer=tf.constant_initializer(0.0))
+            b2 = tf.get_variable(
+                "b2", shape=[4 * self._num_units], initializer=tf.constant_initializer(0.0))
+            b3 = tf.get_variable(
+                "b3", shape=[self._num_units], initializer=tf.constant_initializer(0.0))
 
             # s1 = tf.Variable(tf.ones([4 * self._num_units]), name="s1")
             # s2 = tf.Variable(tf.ones([4 * self._num_units]), name="s2")
@@ -252,10 +379,10 @@ class LNBasicLSTMCell(rnn_cell.RNNCell):
 
             input_below_ = rnn_cell._linear([inputs],
                                             4 * self._num_units, False, scope="out_1")
-            input_below_ = ln(input_below_, s1, b1)
+            input_below_ = _ln_lstm(input_below_, s1, b1, self._per_gate_ln)
             state_below_ = rnn_cell._linear([h],
                                             4 * self._num_units, False, scope="out_2")
-            state_below_ = ln(state_below_, s2, b2)
+            state_below_ = _ln_lstm(state_below_, s2, b2, self._per_gate_ln)
             lstm_matrix = tf.add(input_below_, state_below_)
 
             i, j, f, o = tf.split(1, 4, lstm_matrix)
@@ -286,17 +413,23 @@ class HyperLnLSTMCell(rnn_cell.RNNCell):
     """
 
     def __init__(self, num_units, forget_bias=1.0, input_size=None, 
-        state_is_tuple=False, activation=tf.tanh, hyper_num_units=128, hyper_embedding_size=32, is_layer_norm=True):
+        state_is_tuple=True, activation=tf.tanh, hyper_num_units=128, hyper_embedding_size=32, is_layer_norm=True,
+        per_gate_ln=False):
         """Initialize the basic LSTM cell.
         Args:
           num_units: int, The number of units in the LSTM cell.
           hyper_num_units: int, The number of units in the HyperLSTM cell.
           forget_bias: float, The bias added to forget gates (see above).
           input_size: Deprecated and unused.
-          state_is_tuple: If True, accepted and returned states are 2-tuples of
-            the `c_state` and `m_state`.  By default (False), they are concatenated
-            along the column axis.  This default behavior will soon be deprecated.
+          state_is_tuple: If True (default), accepted and returned states are
+            nested tuples `((c, h), (hyper_c, hyper_h))` of the main and the hyper
+            LSTM, passed through without copies. If False, they are one tensor
+            `[h, hyper | c, hyper]` that is split and rebuilt at every step; only
+            kept for compatibility.
           activation: Activation function of the inner states.
+          is_layer_norm: If True, the gates are layer normalized after the hyper norm.
+          per_gate_ln: If True, each gate is layer normalized with its own
+            statistics instead of all four gates sharing them.
         """
         if not state_is_tuple:
             print("%s: Using a concatenated state is slower and will soon be "
@@ -307,17 +440,18 @@ class HyperLnLSTMCell(rnn_cell.RNNCell):
         self._forget_bias = forget_bias
         self._state_is_tuple = state_is_tuple
         self._activation = activation
+        self._per_gate_ln = per_gate_ln
         self.hyper_num_units = hyper_num_units
         self.total_num_units = self._num_units + self.hyper_num_units
-        self.hyper_cell = rnn_cell.BasicLSTMCell(hyper_num_units)
+        self.hyper_cell = rnn_cell.BasicLSTMCell(hyper_num_units, state_is_tuple=state_is_tuple)
         self.hyper_embedding_size = hyper_embedding_size
         self.is_layer_norm = is_layer_norm
 
     @property
     def state_size(self):
+        if self._state_is_tuple:
+            return (LSTMStateTuple(self._num_units, self._num_units), self.hyper_cell.state_size)
         return 2 * self.total_num_units
-        # return (LSTMStateTuple(self._num_units, self._num_units)
-        #         if self._state_is_tuple else 2 * self._num_units)
 
     @property
     def output_size(self):
@@ -338,12 +472,15 @@ class HyperLnLSTMCell(rnn_cell.RNNCell):
         with tf.variable_scope(scope or type(self).__name__):
             # Parameters of gates are concatenated into one multiply for
             # efficiency.
-            total_h, total_c = tf.split(1, 2, state)
-            h = total_h[:, 0:self._num_units]
-            c = total_c[:, 0:self._num_units]
+            if self._state_is_tuple:
+                (c, h), self.hyper_state = state
+            else:
+                total_h, total_c = tf.split(1, 2, state)
+                h = total_h[:, 0:self._num_units]
+                c = total_c[:, 0:self._num_units]
 
-            self.hyper_state = tf.concat(
-                1, [total_h[:, self._num_units:], total_c[:, self._num_units:]])
+                self.hyper_state = tf.concat(
+                    1, [total_h[:, self._num_units:], total_c[:, self._num_units:]])
             hyper_input = tf.concat(1, [inputs, h])
             hyper_output, hyper_new_state = self.hyper_cell(
                 hyper_input, self.hyper_state)
@@ -360,23 +497,23 @@ class HyperLnLSTMCell(rnn_cell.RNNCell):
                 state_below_, 4 * self._num_units, scope="hyper_h")
 
             if self.is_layer_norm:
-                s1 = tf.get_variable("s1", initializer=tf.ones(
-                    [4 * self._num_units]), dtype=tf.float32)
-                s2 = tf.get_variable("s2", initializer=tf.ones(
-                    [4 * self._num_units]), dtype=tf.float32)
-                s3 = tf.get_variable("s3", initializer=tf.ones(
-                    [self._num_units]), dtype=tf.float32)
+                s1 = tf.get_variable(
+                    "s1", shape=[4 * self._num_units], initializer=tf.constant_initializer(1.0))
+                s2 = tf.get_variable(
+                    "s2", shape=[4 * self._num_units], initializer=tf.constant_initializer(1.0))
+                s3 = tf.get_variable(
+                    "s3", shape=[self._num_units], initializer=tf.constant_initializer(1.0))
 
-                b1 = tf.get_variable("b1", initializer=tf.zeros(
-                    [4 * self._num_units]), dtype=tf.float32)
-                b2 = tf.get_variable("b2", initializer=tf.zeros(
-                    [4 * self._num_units]), dtype=tf.float32)
-                b3 = tf.get_variable("b3", initializer=tf.zeros(
-                    [self._num_units]), dtype=tf.float32)
+                b1 = tf.get_variable(
+                    "b1", shape=[4 * self._num_units], initializer=tf.constant_initializer(0.0))
+                b2 = tf.get_variable(
+                    "b2", shape=[4 * self._num_units], initializer=tf.constant_initializer(0.0))
+                b3 = tf.get_variable(
+                    "b3", shape=[self._num_units], initializer=tf.constant_initializer(0.0))
 
-                input_below_ = ln(input_below_, s1, b1)
+                input_below_ = _ln_lstm(input_below_, s1, b1, self._per_gate_ln)
 
-                state_below_ = ln(state_below_, s2, b2)
+                state_below_ = _ln_lstm(state_below_, s2, b2, self._per_gate_ln)
 
             lstm_matrix = tf.add(input_below_, state_below_)
             i, j, f, o = tf.split(1, 4, lstm_matrix)
@@ -387,6 +524,9 @@ class HyperLnLSTMCell(rnn_cell.RNNCell):
             new_c_ = new_c
             new_h = self._activation(new_c_) * tf.sigmoid(o)
 
+            if self._state_is_tuple:
+                return new_h, (LSTMStateTuple(new_c, new_h), hyper_new_state)
+
             hyper_h, hyper_c = tf.split(1, 2, hyper_new_state)
             new_total_h = tf.concat(1, [new_h, hyper_h])
             new_total_c = tf.concat(1, [new_c, hyper_c])
@@ -410,7 +550,8 @@ class LNLSTMCell(rnn_cell.RNNCell):
     """
 
     def __init__(self, num_units, input_size=None, initializer=None,
-        num_proj=None, state_is_tuple=False, activation=tf.tanh):
+        num_proj=None, proj_clip=None, ln_proj=False, state_is_tuple=False, activation=tf.tanh,
+        per_gate_ln=False):
         """Initialize the parameters for an LSTM cell.
         Args:
           num_units: int, The number of units in the LSTM cell
@@ -425,6 +566,8 @@ class LNLSTMCell(rnn_cell.RNNCell):
           proj_clip: (optional) A float value.  If `num_proj > 0` and `proj_clip` is
           provided, then the projected values are clipped elementwise to within
           `[-proj_clip, proj_clip]`.
+          ln_proj: If True and `num_proj > 0`, the projected output is layer
+            normalized (before clipping).
           num_unit_shards: How to split the weight matrix.  If >1, the weight
             matrix is stored across num_unit_shards.
           num_proj_shards: How to split the projection matrix.  If >1, the
@@ -436,6 +579,8 @@ class LNLSTMCell(rnn_cell.RNNCell):
             the `c_state` and `m_state`.  By default (False), they are concatenated
             along the column axis.  This default behavior will soon be deprecated.
           activation: Activation function of the inner states.
+          per_gate_ln: If True, each gate is layer normalized with its own
+            statistics instead of all four gates sharing them.
         """
         if not state_is_tuple:
             print(
@@ -446,8 +591,11 @@ class LNLSTMCell(rnn_cell.RNNCell):
         self._num_units = num_units
         self._initializer = initializer
         self._num_proj = num_proj
+        self._proj_clip = proj_clip
+        self._ln_proj = ln_proj
         self._state_is_tuple = state_is_tuple
         self._activation = activation
+        self._per_gate_ln = per_gate_ln
 
         if num_proj:
             self._state_size = (
@@ -506,19 +654,19 @@ class LNLSTMCell(rnn_cell.RNNCell):
         with tf.variable_scope(scope or type(self).__name__,
                                initializer=self._initializer):  # "LSTMCell"
 
-            s1 = tf.get_variable("s1", initializer=tf.ones(
-                [4 * self._num_units]), dtype=tf.float32)
-            s2 = tf.get_variable("s2", initializer=tf.ones(
-                [4 * self._num_units]), dtype=tf.float32)
-            s3 = tf.get_variable("s3", initializer=tf.ones(
-                [self._num_units]), dtype=tf.float32)
+            s1 = tf.get_variable(
+                "s1", shape=[4 * self._num_units], initializer=tf.constant_initializer(1.0))
+            s2 = tf.get_variable(
+                "s2", shape=[4 * self._num_units], initializer=tf.constant_initializer(1.0))
+            s3 = tf.get_variable(
+                "s3", shape=[self._num_units], initializer=tf.constant_initializer(1.0))
 
-            b1 = tf.get_variable("b1", initializer=tf.zeros(
-                [4 * self._num_units]), dtype=tf.float32)
-            b2 = tf.get_variable("b2", initializer=tf.zeros(
-                [4 * self._num_units]), dtype=tf.float32)
-            b3 = tf.get_variable("b3", initializer=tf.zeros(
-                [self._num_units]), dtype=tf.float32)
+            b1 = tf.get_variable(
+                "b1", shape=[4 * self._num_units], initializer=tf.constant_initializer(0.0))
+            b2 = tf.get_variable(
+                "b2", shape=[4 * self._num_units], initializer=tf.constant_initializer(0.0))
+            b3 = tf.get_variable(
+                "b3", shape=[self._num_units], initializer=tf.constant_initializer(0.0))
 
             # s1 = tf.Variable(tf.ones([4 * self._num_units]), name="s1")
             # s2 = tf.Variable(tf.ones([4 * self._num_units]), name="s2")
@@ -530,10 +678,10 @@ class LNLSTMCell(rnn_cell.RNNCell):
 
             input_below_ = rnn_cell._linear([inputs],
                                             4 * self._num_units, False, scope="out_1")
-            input_below_ = ln(input_below_, s1, b1)
+            input_below_ = _ln_lstm(input_below_, s1, b1, self._per_gate_ln)
             state_below_ = rnn_cell._linear([m_prev],
                                             4 * self._num_units, False, scope="out_2")
-            state_below_ = ln(state_below_, s2, b2)
+            state_below_ = _ln_lstm(state_below_, s2, b2, self._per_gate_ln)
             lstm_matrix = tf.add(input_below_, state_below_)
 
             i, j, f, o = tf.split(1, 4, lstm_matrix)
@@ -546,6 +694,19 @@ class LNLSTMCell(rnn_cell.RNNCell):
             c_ = c
             m = tf.sigmoid(o) * self._activation(c_)
 
+            if self._num_proj:
+                # the next step's state matmul then reads num_proj instead of num_units columns
+                with tf.variable_scope("projection"):
+                    m = rnn_cell._linear([m], self._num_proj, False, scope="out_proj")
+                    if self._ln_proj:
+                        s_proj = tf.get_variable(
+                            "s_proj", shape=[self._num_proj], initializer=tf.constant_initializer(1.0))
+                        b_proj = tf.get_variable(
+                            "b_proj", shape=[self._num_proj], initializer=tf.constant_initializer(0.0))
+                        m = ln(m, s_proj, b_proj)
+                if self._proj_clip is not None:
+                    m = tf.clip_by_value(m, -self._proj_clip, self._proj_clip)
+
         new_state = (LSTMStateTuple(c, m) if self._state_is_tuple
                      else tf.concat(1, [c, m]))
         return m, new_state
@@ -1,19 +1,24 @@
 import argparse
+import time
 import tensorflow as tf
+from tensorflow.python.util import nest
 import numpy as np
 
 from layers import *
 import streaming
-
-if tf.__version__ == '1.0.0'
+import models
+import dau
+import pipeline
+import profiling
+import checkpoint
+import evaluation
+import dataset
+
+if tf.__version__ == '1.0.0':
     rnn_cell = tf.contrib.rnn
 else:
     rnn_cell = tf.nn.rnn_cell
 
-# Import MINST data
-from tensorflow.examples.tutorials.mnist import input_data
-mnist = input_data.read_data_sets("../data/", one_hot=True)
-
 
 parser = argparse.ArgumentParser(description='Runs instance(s) of an RNN.')
 parser.add_argument('--learning_rate', help='learning rate', type=float, default=0.001)
@@ -24,10 +29,42 @@ parser.add_argument('--hidden', help='# hidden units', type=int, default=50)
 parser.add_argument('--classes', help='# classes', type=int, default=10)
 parser.add_argument('--layers', help='# layers', type=int, default=1)
 parser.add_argument('--dau', help='batches per update for use in decoupled accumulation and update', type=int, default=1)
-parser.add_argument('--cell_type', help='type of RNN', choices=['SNGRU', 'LSTM', 'GRU', 'BasicRNN', 'LNGRU', 'LNLSTM', 'HyperLnLSTMCell'], default='SNGRU')
+parser.add_argument('--cell_type', help='type of RNN', choices=models.CELL_TYPES, default='SNGRU')
+parser.add_argument('--stat_bank', help='for SNGRU: pack the streaming statistics of all layers into one bank of buffers, one slot per layer', action='store_true')
+parser.add_argument('--fused_matmul', help='for SNGRU/LNGRU: one input matmul for all steps and one state matmul per step', action='store_true')
+parser.add_argument('--stream_dtype', help='storage dtype of the streaming buffers (updates stay float32)', choices=['float32', 'float16', 'bfloat16'], default='float32')
+parser.add_argument('--stream_kahan', help='keep the rounding error of narrow streaming buffers in compensation buffers; does not save memory over float32', action='store_true')
+parser.add_argument('--per_gate_ln', help='for LNLSTM/HyperLnLSTMCell: layer normalize each gate with its own statistics', action='store_true')
 parser.add_argument('--hyper_layer_norm', help='for HyperLnLSTMCell use only', action='store_true')
+parser.add_argument('--num_proj', help='for LNLSTM: project the output and recurrent state to this many units (0: no projection)', type=int, default=0)
+parser.add_argument('--proj_clip', help='for LNLSTM with --num_proj: clip the projected values to [-proj_clip, proj_clip] (0: no clipping)', type=float, default=0.0)
+parser.add_argument('--ln_proj', help='for LNLSTM with --num_proj: layer normalize the projected output', action='store_true')
+parser.add_argument('--dynamic', help='build the RNN with a while loop (dynamic_rnn) instead of unrolling it', action='store_true')
+parser.add_argument('--bptt_window', help='truncated BPTT: run the sequence in windows of this many steps, carrying the state, and backpropagate the loss within the last one (0: whole sequence)', type=int, default=0)
+parser.add_argument('--recompute_segment', help='keep only the states every N steps for backprop and recompute the rest (0: keep all)', type=int, default=0)
+parser.add_argument('--prefetch', help='# batches prepared ahead on a background thread (0 to read synchronously)', type=int, default=2)
+parser.add_argument('--trace_every', help='trace every N-th training step (0 to disable)', type=int, default=0)
+parser.add_argument('--trace_dir', help='directory for Chrome traces of traced steps', default='./trace/')
+parser.add_argument('--checkpoint_dir', help='directory for incremental checkpoints (weights and streaming state)', default='')
+parser.add_argument('--checkpoint_every', help='# training steps per checkpoint save (0 to disable)', type=int, default=0)
+parser.add_argument('--checkpoint_full_every', help='write all tensors on every N-th save, so old chunks can be dropped', type=int, default=10)
+parser.add_argument('--resume', help='restore the checkpoint in --checkpoint_dir before training', action='store_true')
+parser.add_argument('--inference_dir', help='save only the weights and frozen streaming statistics here after training', default='')
+parser.add_argument('--eval_every', help='# training steps per evaluation on the full test set (0: only at the end)', type=int, default=100)
+parser.add_argument('--eval_chunk', help='# test images per evaluation run', type=int, default=1000)
+parser.add_argument('--eval_background', help='evaluate snapshots of the weights on a background thread', action='store_true')
+parser.add_argument('--data_dir', help='directory of the MNIST download', default='../data/')
+parser.add_argument('--cache_dir', help='directory of the uint8 dataset cache (default: <data_dir>/cache)', default='')
 parser.add_argument('--summaries_dir', help='directory for summary', default='./log/')
 args = parser.parse_args()
+streaming.storage_dtype = getattr(tf, args.stream_dtype)
+streaming.kahan_compensation = args.stream_kahan
+
+# read the checkpoint while the graph is being built
+restorer = checkpoint.AsyncRestore(args.checkpoint_dir) if args.resume and args.checkpoint_dir else None
+
+# Import MINST data: memory-mapped uint8, dequantized per batch
+mnist = dataset.load(args.data_dir, args.cache_dir or None)
 
 '''
 To classify images using a reccurent neural network, we consider every image
@@ -46,7 +83,15 @@ display_step = args.display_step
 # Network Parameters
 n_input = 28  # MNIST data input (img shape: 28*28)
 n_steps = 28  # timesteps
+if args.bptt_window > 0 and n_steps % args.bptt_window != 0:
+    parser.error('--bptt_window must divide the %d steps of a sequence' % n_steps)
+if args.recompute_segment > 0 and args.dynamic:
+    parser.error('--recompute_segment needs the unrolled RNN, not --dynamic')
+if args.num_proj and args.cell_type != 'LNLSTM':
+    parser.error('--num_proj is only supported for --cell_type LNLSTM')
 n_hidden = args.hidden  # hidden layer num of features
+# features of the last output, read out by the weights
+n_output = args.num_proj or n_hidden
 n_classes = args.classes  # MNIST total classes (0-9 digits)
 
 n_dau = args.dau
@@ -59,7 +104,12 @@ print 'Learning rate: ' + str(learning_rate)
 print 'Batch size: ' + str(batch_size)
 print 'Hidden units: ' + str(n_hidden)
 print 'DAU: ' + str(n_dau)
+if args.bptt_window > 0:
+    print 'BPTT window: ' + str(args.bptt_window)
+if args.recompute_segment > 0:
+    print 'Recompute segment: ' + str(args.recompute_segment)
 print 'Cell type: ' + str(args.cell_type)
+print 'Streaming buffers: ' + args.stream_dtype + (' (compensated, no memory saving over float32)' if args.stream_kahan else '')
 
 # print 'alpha, beta, kappa: '
 # print alpha_global
@@ -80,69 +130,92 @@ def train():
         y = tf.placeholder(tf.float32, [None, n_classes], name='y-input')
 
     weights = {
-        'out': tf.get_variable('weights', shape=[n_hidden, n_classes], initializer=tf.random_normal_initializer())
+        'out': tf.get_variable('weights', shape=[n_output, n_classes], initializer=tf.random_normal_initializer())
     }
     biases = {
         'out': tf.get_variable('biases', shape=[n_classes], initializer=tf.random_normal_initializer())
     }
 
-    def RNN(x, weights, biases, type, hyper_layer_norm, scope=None):
-
-        # Prepare data shape to match `rnn` function requirements
-        # Current data input shape: (batch_size, n_steps, n_input)
-        # Required shape: 'n_steps' tensors list of shape (batch_size, n_input)
-
-        # Permuting batch_size and n_steps
-        x = tf.transpose(x, [1, 0, 2])
-        # Reshaping to (n_steps*batch_size, n_input)
-        x = tf.reshape(x, [-1, n_input])
-        # Split to get a list of 'n_steps' tensors of shape (batch_size, n_input)
-        if tf.__version__ == '1.0.0':
-            x = tf.split(x, n_steps, 0)
-        else:
-            x = tf.split(0, n_steps, x)
-
-        # Define a lstm cell with tensorflow
-        cell_class_map = {
-            "LSTM": rnn_cell.BasicLSTMCell(n_hidden),
-            "GRU": rnn_cell.GRUCell(n_hidden),
-            "BasicRNN": rnn_cell.BasicRNNCell(n_hidden),
-            "LNGRU": LNGRUCell(n_hidden),
-            "SNGRU": SNGRUCell(n_hidden),
-            "LNLSTM": LNBasicLSTMCell(n_hidden),
-            'HyperLnLSTMCell': HyperLnLSTMCell(n_hidden, is_layer_norm=hyper_layer_norm)
-        }
-
-        lstm_cell = cell_class_map.get(type)
-        cell = rnn_cell.MultiRNNCell([lstm_cell] * args.layers, state_is_tuple=True)
+    def Cell(type, hyper_layer_norm, training_mode=True):
         print "Using %s model" % type
-        # Get lstm cell output
-        if tf.__version__ == '1.0.0':
-            outputs, states = rnn_cell.static_rnn(cell, x, dtype=tf.float32, scope=scope)
+        return models.build_cell(type, n_hidden, args.layers, training_mode=training_mode,
+                                 hyper_layer_norm=hyper_layer_norm, stat_bank=args.stat_bank,
+                                 fused_matmul=args.fused_matmul, per_gate_ln=args.per_gate_ln,
+                                 num_proj=args.num_proj, proj_clip=args.proj_clip, ln_proj=args.ln_proj)
+
+    def RNN(x, weights, biases, type, hyper_layer_norm, training_mode=True, scope=None):
+
+        cell = Cell(type, hyper_layer_norm, training_mode)
+        return models.rnn_logits(x, cell, weights, biases, dynamic=args.dynamic, scope=scope)
+
+    # raises the streaming "weights updated" flags whenever gradients are applied
+    optimizer = streaming.StreamingOptimizer(tf.train.AdamOptimizer(learning_rate=learning_rate))
+
+    def cost_fn(logits):
+        return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits, y))
+
+    if args.bptt_window > 0:
+        # truncated BPTT: the graph only unrolls one window; the state is fed in
+        # and fetched out, so it carries over between windows without gradient.
+        # The label is only predicted from the last output of the sequence, so
+        # only the last window has a loss: the earlier ones run forward only to
+        # carry the state (and feed the forward streaming statistics).
+        n_windows = n_steps // args.bptt_window
+        with tf.name_scope('input'):
+            x_window = tf.placeholder(tf.float32, [None, args.bptt_window, n_input], name='x-window')
+        window_cell = Cell(args.cell_type, args.hyper_layer_norm)
+        window_state, window_state_flat = models.state_placeholders(window_cell)
+        if args.recompute_segment > 0:
+            pred, cost, grads, final_state = models.checkpointed_rnn(
+                x_window, window_cell, weights, biases, cost_fn, args.recompute_segment, initial_state=window_state)
         else:
-            outputs, states = tf.nn.rnn(cell, x, dtype=tf.float32, scope=scope)
-
-        # Linear activation, using rnn inner loop last output
-        return tf.matmul(outputs[-1], weights['out']) + biases['out']
-
-    optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)
-
-    pred = RNN(x, weights, biases, args.cell_type, args.hyper_layer_norm)
-    # Define loss and optimizer
-    # print pred
-    cost = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(pred, y))
-    grads = optimizer.compute_gradients(cost)
-
-    grad_placeholder = [(tf.placeholder("float", shape=grad[0].get_shape()), grad[1]) for grad in grads]
+            pred, final_state = models.rnn_window_logits(x_window, window_cell, window_state, weights, biases,
+                                                         dynamic=args.dynamic)
+            cost = cost_fn(pred)
+            grads = optimizer.compute_gradients(cost)
+        final_state_flat = nest.flatten(final_state)
+        # the mean gradient of the last windows of n_dau batches is applied once
+        accumulate_grads, apply_grads = dau.accumulate_gradients(optimizer, grads, n_dau)
+    elif args.recompute_segment > 0:
+        # backprop through recomputed segments; the gradients come with the model
+        pred, cost, grads, _ = models.checkpointed_rnn(x, Cell(args.cell_type, args.hyper_layer_norm),
+                                                       weights, biases, cost_fn, args.recompute_segment)
+    else:
+        pred = RNN(x, weights, biases, args.cell_type, args.hyper_layer_norm)
+        # Define loss and optimizer
+        # print pred
+        cost = cost_fn(pred)
+        grads = optimizer.compute_gradients(cost)
+
+    if args.bptt_window == 0:
+        if n_dau == 1:
+            apply_grads = optimizer.apply_gradients(grads)
+        else:
+            accumulate_grads, apply_grads = dau.accumulate_gradients(optimizer, grads, n_dau)
+
+    def run_windows(batch_x, batch_y, run_kwargs):
+        state = models.zero_state_values(window_cell, len(batch_x))
+        for w in range(n_windows):
+            feed = {x_window: batch_x[:, w * args.bptt_window:(w + 1) * args.bptt_window], y: batch_y}
+            feed.update(zip(window_state_flat, state))
+            if w < n_windows - 1:
+                state = sess.run(final_state_flat, feed_dict=feed)
+            else:
+                # only the last window, the one with the loss, of a traced step is traced
+                sess.run(accumulate_grads, feed_dict=feed, **run_kwargs)
 
-    apply_grads = optimizer.apply_gradients(grad_placeholder)
+    # evaluation graph: same weights, frozen streaming statistics, no assigns
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        pred_eval = RNN(x, weights, biases, args.cell_type, args.hyper_layer_norm, training_mode=False)
+    cost_eval = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(pred_eval, y))
 
-    correct_pred = tf.equal(tf.argmax(pred, 1), tf.argmax(y, 1))
+    correct_pred = tf.equal(tf.argmax(pred_eval, 1), tf.argmax(y, 1))
     accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
+    test_sums = evaluation.eval_sums(pred_eval, y)
 
     if tensorboard:
         tf.summary.scalar('Accuracy', accuracy)
-        tf.summary.scalar('Cost', cost)
+        tf.summary.scalar('Cost', cost_eval)
 
         merged = tf.summary.merge_all()
         train_writer = tf.summary.FileWriter(args.summaries_dir + "train/", sess.graph)
@@ -153,32 +226,73 @@ def train():
     for v in tf.trainable_variables():
         print v.name
     sess.run(init)
-    test_len = 128
-    test_data = mnist.test.images[:test_len].reshape((-1, n_steps, n_input))
-    test_label = mnist.test.labels[:test_len]
     step = 1
-    
+    if restorer is not None:
+        manifest = restorer.restore(sess)
+        if manifest is not None:
+            step = manifest['step'] + 1
+            print "Resumed from step " + str(manifest['step'])
+    if args.checkpoint_dir and args.checkpoint_every > 0:
+        checkpointer = checkpoint.Checkpointer(args.checkpoint_dir, full_every=args.checkpoint_full_every)
+
+    def report_test(step, acc, loss):
+        print "Step " + str(step) + ", Testing Loss= " + "{:.6f}".format(loss) + \
+            ", Testing Accuracy= " + "{:.5f}".format(acc)
+        if tensorboard:
+            summary = tf.Summary(value=[tf.Summary.Value(tag='Accuracy', simple_value=acc),
+                                        tf.Summary.Value(tag='Cost', simple_value=loss)])
+            test_writer.add_summary(summary, step)
+
+    def build_eval(x_eval, y_eval):
+        # the inference model again, in the graph of the background evaluator
+        eval_weights = {
+            'out': tf.get_variable('weights', shape=[n_output, n_classes], initializer=tf.random_normal_initializer())
+        }
+        eval_biases = {
+            'out': tf.get_variable('biases', shape=[n_classes], initializer=tf.random_normal_initializer())
+        }
+        pred_test = RNN(x_eval, eval_weights, eval_biases, args.cell_type, args.hyper_layer_norm, training_mode=False)
+        return evaluation.eval_sums(pred_test, y_eval)
+
+    if args.eval_background:
+        evaluator = evaluation.BackgroundEvaluator(build_eval, [n_steps, n_input], n_classes,
+                                                   mnist.test.images, mnist.test.labels,
+                                                   checkpoint.inference_variables(), report_test,
+                                                   chunk_size=args.eval_chunk)
+
     dau_counter = 0
-    grad_vals = []
+    input_wait = 0.0
+    if args.prefetch > 0:
+        train_batches = pipeline.BatchPrefetcher(mnist.train, batch_size, [n_steps, n_input], depth=args.prefetch)
     # Keep training until reach max iterations
     while step * batch_size < training_iters:
-        batch_x, batch_y = mnist.train.next_batch(batch_size)
-        batch_x = batch_x.reshape([batch_size, n_steps, n_input])
+        if args.prefetch > 0:
+            batch_x, batch_y = train_batches.next_batch()
+            input_wait += train_batches.last_wait
+        else:
+            input_start = time.time()
+            batch_x, batch_y = mnist.train.next_batch(batch_size)
+            batch_x = batch_x.reshape([batch_size, n_steps, n_input])
+            input_wait += time.time() - input_start
         streaming_norm_training_mode_global_flag = True
         
-        #sess.run(apply_grads, feed_dict={x: batch_x, y: batch_y})
-        grad_vals.append(sess.run([grad[0] for grad in grads], feed_dict={x: batch_x, y: batch_y}))
+        run_kwargs = {}
+        if args.trace_every > 0 and step % args.trace_every == 0:
+            run_metadata = tf.RunMetadata()
+            run_kwargs = {'options': profiling.full_trace_options(), 'run_metadata': run_metadata}
+        if args.bptt_window > 0:
+            run_windows(batch_x, batch_y, run_kwargs)
+        elif n_dau == 1:
+            sess.run(apply_grads, feed_dict={x: batch_x, y: batch_y}, **run_kwargs)
+        else:
+            sess.run(accumulate_grads, feed_dict={x: batch_x, y: batch_y}, **run_kwargs)
+        if run_kwargs:
+            profiling.report(run_metadata, sess.graph, args.trace_dir, step)
         dau_counter += 1
         if dau_counter == n_dau:
             dau_counter = 0
-            feed = {}
-            for i in range(len(grad_vals[0])):
-                feed[grad_placeholder[i][0]] = grad_vals[0][i]
-                for j in range(1, n_dau):
-                    feed[grad_placeholder[i][0]] += grad_vals[j][i]
-                feed[grad_placeholder[i][0]] /= n_dau
-            sess.run(apply_grads, feed_dict=feed)
-            grad_vals = []
+            if n_dau != 1 or args.bptt_window > 0:
+                sess.run(apply_grads)
             if tensorboard:
                 summary = sess.run(merged, feed_dict={x: batch_x, y: batch_y})
                 train_writer.add_summary(summary, step)
@@ -186,31 +300,46 @@ def train():
         if step % display_step == 0:
             # Calculate batch accuracy
             if tensorboard:
-                summary, acc, loss = sess.run([merged, accuracy, cost], feed_dict={x: batch_x, y: batch_y})
+                summary, acc, loss = sess.run([merged, accuracy, cost_eval], feed_dict={x: batch_x, y: batch_y})
                 train_writer.add_summary(summary, step)
             else:
-                acc, loss = sess.run([accuracy, cost], feed_dict={x: batch_x, y: batch_y})
+                acc, loss = sess.run([accuracy, cost_eval], feed_dict={x: batch_x, y: batch_y})
                 
             # Calculate batch loss
             print "Iter " + str(step * batch_size) + ", Minibatch Loss= " + \
                 "{:.6f}".format(loss) + ", Training Accuracy= " + \
-                "{:.5f}".format(acc)
+                "{:.5f}".format(acc) + ", Input Wait= " + \
+                "{:.3f}ms/step".format(1000 * input_wait / display_step)
+            input_wait = 0.0
             streaming_norm_training_mode_global_flag = False
 
-            if tensorboard:
-                summary, acc, loss = sess.run([merged, accuracy, cost], feed_dict={x: test_data, y: test_label})
-                test_writer.add_summary(summary, step)
+        if args.eval_every > 0 and step % args.eval_every == 0:
+            if args.eval_background:
+                evaluator.submit(sess, step)
             else:
-                acc, loss = sess.run([accuracy, cost], feed_dict={x: test_data, y: test_label})
-
-            print "Testing Accuracy:", acc
+                acc, loss = evaluation.evaluate(sess, test_sums, x, y, mnist.test.images, mnist.test.labels,
+                                                args.eval_chunk)
+                report_test(step, acc, loss)
+        # only between updates, so no gradients are half accumulated
+        if args.checkpoint_dir and args.checkpoint_every > 0 and step % args.checkpoint_every == 0 and dau_counter == 0:
+            checkpointer.save(sess, step)
         step += 1
+    if args.prefetch > 0:
+        train_batches.stop()
+    if args.checkpoint_dir and args.checkpoint_every > 0:
+        checkpointer.save(sess, step - 1)
+        checkpointer.wait()
+    if args.inference_dir:
+        inference = checkpoint.Checkpointer(args.inference_dir, checkpoint.inference_variables(), full_every=1)
+        inference.save(sess, step - 1)
+        inference.wait()
+    if args.eval_background:
+        evaluator.stop()
     print "Optimization Finished!"
 
-    # Calculate accuracy for 128 mnist test images
-
-    print "Testing Accuracy:", \
-        sess.run(accuracy, feed_dict={x: test_data, y: test_label})
+    # Calculate accuracy for all mnist test images
+    acc, loss = evaluation.evaluate(sess, test_sums, x, y, mnist.test.images, mnist.test.labels, args.eval_chunk)
+    print "Testing Accuracy:", acc
 
 
 def main(_):
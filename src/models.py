@@ -0,0 +1,233 @@
+""" RNN classifiers over the cells in layers.py, shared by the training and benchmark scripts """
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.util import nest
+
+from layers import *
+import streaming
+
+if tf.__version__ == '1.0.0':
+    rnn_cell = tf.contrib.rnn
+else:
+    rnn_cell = tf.nn.rnn_cell
+
+CELL_TYPES = ['SNGRU', 'LSTM', 'GRU', 'BasicRNN', 'LNGRU', 'LNLSTM', 'HyperLnLSTMCell']
+
+# the variable scope tf.nn.rnn / static_rnn and dynamic_rnn put the cells in
+RNN_SCOPE = 'rnn' if tf.__version__ == '1.0.0' else 'RNN'
+
+
+def build_cell(type, n_hidden, n_layers=1, training_mode=True, hyper_layer_norm=False,
+               stat_bank=False, fused_matmul=False, per_gate_ln=False, num_proj=0, proj_clip=0.0,
+               ln_proj=False):
+    """Stacks n_layers cells of the given type into a MultiRNNCell.
+
+    With fused_matmul, the first layer of a SNGRU or LNGRU stack takes its
+    inputs already projected (see project_inputs), so rnn_window_logits and
+    checkpointed_rnn project the inputs of all timesteps in one matmul. With
+    stat_bank, the layers of a SNGRU stack stream their statistics into the
+    slots of one streaming.StatBank. With num_proj, LNLSTM layers are
+    LNLSTMCells projecting their output (and recurrent state) to num_proj
+    units, layer normalized with ln_proj and clipped to proj_clip if nonzero;
+    the output of the stack then has num_proj units.
+    """
+    # Define a lstm cell with tensorflow
+    cell_class_map = {
+        "LSTM": lambda: rnn_cell.BasicLSTMCell(n_hidden),
+        "GRU": lambda: rnn_cell.GRUCell(n_hidden),
+        "BasicRNN": lambda: rnn_cell.BasicRNNCell(n_hidden),
+        "LNGRU": lambda: LNGRUCell(n_hidden, fused_matmul=fused_matmul),
+        "SNGRU": lambda: SNGRUCell(n_hidden, training_mode=training_mode, stat_bank=stat_bank,
+                                   fused_matmul=fused_matmul),
+        "LNLSTM": lambda: (LNLSTMCell(n_hidden, num_proj=num_proj, proj_clip=proj_clip or None, ln_proj=ln_proj,
+                                      state_is_tuple=True, per_gate_ln=per_gate_ln)
+                           if num_proj else LNBasicLSTMCell(n_hidden, per_gate_ln=per_gate_ln)),
+        'HyperLnLSTMCell': lambda: HyperLnLSTMCell(n_hidden, is_layer_norm=hyper_layer_norm,
+                                                   per_gate_ln=per_gate_ln)
+    }
+
+    if type == 'SNGRU' and (stat_bank or fused_matmul):
+        bank = streaming.StatBank(n_layers) if stat_bank else None
+        cells = [SNGRUCell(n_hidden, training_mode=training_mode, stat_bank=bank, bank_slot=i,
+                           fused_matmul=fused_matmul, input_projected=fused_matmul and i == 0)
+                 for i in range(n_layers)]
+    elif type == 'LNGRU' and fused_matmul:
+        cells = [LNGRUCell(n_hidden, fused_matmul=True, input_projected=i == 0) for i in range(n_layers)]
+    else:
+        cells = [cell_class_map[type]()] * n_layers
+    cell = rnn_cell.MultiRNNCell(cells, state_is_tuple=True)
+    if fused_matmul and type in ('SNGRU', 'LNGRU'):
+        # read by project_inputs
+        cell.projected_input_units = n_hidden
+    return cell
+
+
+def project_inputs(x, cell):
+    """ The inputs of the first layer of cell for the 2D inputs x: x itself, or,
+    for a fused GRU stack from build_cell, x projected to 3 * units by one
+    matmul over all its rows. Build it inside the variable scope of the rnn. """
+    units = getattr(cell, 'projected_input_units', None)
+    if units is None:
+        return x
+    return project_gru_inputs(x, units)
+
+
+def rnn_logits(x, cell, weights, biases, dynamic=False, scope=None):
+    """ Runs cell over x of shape (batch_size, n_steps, n_input) and returns the
+    linear read-out of the last output """
+    logits, _ = rnn_window_logits(x, cell, None, weights, biases, dynamic=dynamic, scope=scope)
+    return logits
+
+
+def rnn_window_logits(x, cell, initial_state, weights, biases, dynamic=False, scope=None):
+    """ Like rnn_logits, but starts from initial_state (zero if None) and also
+    returns the final state, so a sequence can be run window by window """
+    n_steps = x.get_shape()[1].value
+    n_input = x.get_shape()[2].value
+    state_kwargs = {'dtype': tf.float32} if initial_state is None else {'initial_state': initial_state}
+
+    if dynamic:
+        with tf.variable_scope(scope or RNN_SCOPE):
+            projected = project_inputs(tf.reshape(x, [-1, n_input]), cell)
+        x = tf.reshape(projected, [-1, n_steps, projected.get_shape()[1].value])
+        # the cell is built once inside a while loop, so the graph (and the
+        # streaming variables of each layer) does not grow with n_steps
+        # one iteration at a time: the streaming updates of the iterations read
+        # and assign the same variables, and cannot be chained across the loop
+        with streaming.unchained():
+            outputs, states = tf.nn.dynamic_rnn(cell, x, scope=scope, parallel_iterations=1, **state_kwargs)
+        # (batch_size, n_steps, n_hidden) -> last output
+        last_output = tf.transpose(outputs, [1, 0, 2])[-1]
+        return tf.matmul(last_output, weights['out']) + biases['out'], states
+
+    # Prepare data shape to match `rnn` function requirements
+    # Current data input shape: (batch_size, n_steps, n_input)
+    # Required shape: 'n_steps' tensors list of shape (batch_size, n_input)
+
+    # Permuting batch_size and n_steps
+    x = tf.transpose(x, [1, 0, 2])
+    # Reshaping to (n_steps*batch_size, n_input)
+    x = tf.reshape(x, [-1, n_input])
+    # for fused GRU cells, the input projection of all steps in one matmul
+    with tf.variable_scope(scope or RNN_SCOPE):
+        x = project_inputs(x, cell)
+    # Split to get a list of 'n_steps' tensors of shape (batch_size, n_input)
+    if tf.__version__ == '1.0.0':
+        x = tf.split(x, n_steps, 0)
+    else:
+        x = tf.split(0, n_steps, x)
+
+    # Get lstm cell output
+    if tf.__version__ == '1.0.0':
+        outputs, states = rnn_cell.static_rnn(cell, x, scope=scope, **state_kwargs)
+    else:
+        outputs, states = tf.nn.rnn(cell, x, scope=scope, **state_kwargs)
+
+    # Linear activation, using rnn inner loop last output
+    return tf.matmul(outputs[-1], weights['out']) + biases['out'], states
+
+
+def state_placeholders(cell, name='state'):
+    """ Placeholders for a (possibly nested) state of cell, of any batch size.
+    Returns the state structure and its flat list of placeholders """
+    sizes = nest.flatten(cell.state_size)
+    flat = [tf.placeholder(tf.float32, [None, size], name='%s%d' % (name, i)) for i, size in enumerate(sizes)]
+    return nest.pack_sequence_as(cell.state_size, flat), flat
+
+
+def zero_state_values(cell, batch_size):
+    """ Zero values for the flat list of state_placeholders """
+    return [np.zeros([batch_size, size], dtype=np.float32) for size in nest.flatten(cell.state_size)]
+
+
+def checkpointed_rnn(x, cell, weights, biases, cost_fn, segment_steps, initial_state=None, scope=None):
+    """Unrolls cell over x like rnn_window_logits and builds the gradients of
+    cost_fn(logits) with activation recomputation.
+
+    Only the states at the boundaries of segments of segment_steps steps are
+    kept for backprop. Each segment is built a second time, behind control
+    dependencies on the gradient flowing into its end, so it only runs during
+    the backward pass, and differentiated there. The streaming statistics
+    of the first build are replayed in the second (streaming.replaying), so
+    the forward side is updated once; the gradient side is only built for
+    the recomputed segments. The boundary states enter the second build
+    through tf.stop_gradient, so every segment is differentiated once, and
+    the gradient with respect to them is fed to the previous segment.
+
+    Returns:
+      logits, cost, grads_and_vars (over the trainable variables) and the
+      final state.
+    """
+    n_steps = x.get_shape()[1].value
+    n_input = x.get_shape()[2].value
+    if initial_state is None:
+        initial_state = cell.zero_state(tf.shape(x)[0], tf.float32)
+
+    def step_inputs(start, length):
+        # first-layer inputs of steps start..start+length-1, projected in one
+        # matmul for fused GRU cells
+        xs = tf.transpose(tf.slice(x, [0, start, 0], [-1, length, -1]), [1, 0, 2])
+        xs = project_inputs(tf.reshape(xs, [-1, n_input]), cell)
+        if tf.__version__ == '1.0.0':
+            return tf.split(xs, length, 0)
+        return tf.split(0, length, xs)
+
+    segments = [range(start, min(start + segment_steps, n_steps)) for start in range(0, n_steps, segment_steps)]
+    # the scope tf.nn.rnn / static_rnn use, so the variables are shared with rnn_logits graphs
+    with tf.variable_scope(scope or RNN_SCOPE) as varscope:
+        xs = step_inputs(0, n_steps)
+        # first build: forward only, recording the boundary states and statistics
+        boundaries = []
+        tapes = []
+        state = initial_state
+        for segment in segments:
+            boundaries.append(state)
+            tapes.append([])
+            with streaming.recording(tapes[-1]):
+                for t in segment:
+                    if t > 0:
+                        varscope.reuse_variables()
+                    output, state = cell(xs[t], state)
+        final_state = state
+        logits = tf.matmul(output, weights['out']) + biases['out']
+        cost = cost_fn(logits)
+
+        variables = tf.trainable_variables()
+        grads = dict((v, []) for v in variables)
+        readout = [weights['out'], biases['out']]
+        grad_output, grad_w, grad_b = tf.gradients(cost, [output] + readout)
+        grads[readout[0]].append(grad_w)
+        grads[readout[1]].append(grad_b)
+
+        # second build, last segment first: recompute, then differentiate
+        grad_state = [None] * len(nest.flatten(final_state))
+        for k in reversed(range(len(segments))):
+            incoming = [g for g in grad_state if g is not None]
+            if k == len(segments) - 1:
+                incoming.append(grad_output)
+            with tf.control_dependencies(incoming):
+                # the leaves cut the graph at the boundary: the gradient into the
+                # earlier segments is only passed on by hand, as grad_state
+                leaves = [tf.stop_gradient(s) for s in nest.flatten(boundaries[k])]
+                state = nest.pack_sequence_as(boundaries[k], leaves)
+                varscope.reuse_variables()
+                # sliced from x again, so the input side is recomputed here too
+                # rather than kept from the first build
+                segment_xs = step_inputs(segments[k][0], len(segments[k]))
+                with streaming.replaying(tapes[k]):
+                    for x_t in segment_xs:
+                        recomputed_output, state = cell(x_t, state)
+            ys = nest.flatten(state)
+            grad_ys = [tf.zeros_like(y) if g is None else g for y, g in zip(ys, grad_state)]
+            if k == len(segments) - 1:
+                ys.append(recomputed_output)
+                grad_ys.append(grad_output)
+            segment_grads = tf.gradients(ys, leaves + variables, grad_ys=grad_ys)
+            grad_state = segment_grads[:len(leaves)]
+            for v, g in zip(variables, segment_grads[len(leaves):]):
+                if g is not None:
+                    grads[v].append(g)
+
+    grads_and_vars = [(tf.add_n(grads[v]) if grads[v] else None, v) for v in variables]
+    return logits, cost, grads_and_vars, final_state
@@ -0,0 +1,328 @@
+""" Data-parallel MNIST training over several local worker processes.
+
+Every worker trains the same model on its own shard of the training set with
+an equal part of the global batch. After each step the workers all-reduce
+through per-worker rows of a shared memory file: the gradients are averaged
+and applied by every worker, and the short windows of all streaming sites are
+merged (see streaming_np.merge_windows), so the streaming statistics stay the
+same on every worker. A plain single-process run of the same global batch,
+without any all-reduce, is timed first, and the scaling efficiency of the
+N-process run is reported against it.
+
+  python parallel.py --workers 4 --cell_type SNGRU --batch_size 128
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+# same as models.CELL_TYPES; importing models here would load tensorflow in the parent
+CELL_TYPES = ['SNGRU', 'LSTM', 'GRU', 'BasicRNN', 'LNGRU', 'LNLSTM', 'HyperLnLSTMCell']
+
+n_input = 28
+n_steps = 28
+n_classes = 10
+
+
+class Barrier(object):
+    """ Reusable barrier for processes (multiprocessing.Barrier is python 3 only) """
+
+    def __init__(self, parties):
+        self._parties = parties
+        self._cond = mp.Condition()
+        self._count = mp.Value('i', 0, lock=False)
+        self._generation = mp.Value('i', 0, lock=False)
+
+    def wait(self):
+        with self._cond:
+            generation = self._generation.value
+            self._count.value += 1
+            if self._count.value == self._parties:
+                self._count.value = 0
+                self._generation.value += 1
+                self._cond.notify_all()
+            else:
+                while generation == self._generation.value:
+                    self._cond.wait()
+
+
+class Flattener(object):
+    """ Packs the values of a list of variables into one flat vector and back """
+
+    def __init__(self, variables):
+        self.shapes = [v.get_shape().as_list() for v in variables]
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.cumsum([0] + sizes)
+        self.size = int(self.offsets[-1])
+
+    def flatten(self, values, out):
+        for i, value in enumerate(values):
+            out[self.offsets[i]:self.offsets[i + 1]] = np.ravel(value)
+
+    def unflatten(self, flat):
+        return [flat[self.offsets[i]:self.offsets[i + 1]].reshape(shape)
+                for i, shape in enumerate(self.shapes)]
+
+
+def assign_from_placeholders(variables):
+    """ Returns placeholders shaped like the variables and one op assigning them """
+    import tensorflow as tf
+    placeholders = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in variables]
+    assign = tf.group(*[v.assign(p) for v, p in zip(variables, placeholders)])
+    return placeholders, assign
+
+
+def merge_stats(rows, sides, flat_sides, out):
+    """Merges the streaming statistics of all workers into `out`.
+
+    rows are the per-worker stat vectors; every side is laid out as
+    [long, short, short_m2, short_counter]. The gradients are applied on every
+    step, so each window only holds the samples of the last step and the
+    windows of the workers are disjoint; long is the same on all workers.
+    final is not merged: on the gradient side it is not linear in the short
+    mean (it adds in the raw gradient), so the forward final is recomputed
+    from the merged long and short (streaming.rebuild_final_statistics) and
+    the gradient final is rebuilt by the next backward pass.
+    """
+    import streaming_np
+    offset = 0
+    for side in sides:
+        parts = [flat_sides[side].unflatten(row[offset:offset + flat_sides[side].size]) for row in rows]
+        longs, shorts, m2s, counters = zip(*parts)
+        counter, short, m2 = streaming_np.merge_windows(counters, shorts, m2s)
+        flat_sides[side].flatten([np.mean(longs, axis=0), short, m2, counter],
+                                 out[offset:offset + flat_sides[side].size])
+        offset += flat_sides[side].size
+
+
+def worker(rank, n_workers, args, buffer_dir, barrier, results):
+    import tensorflow as tf
+    import models
+    import streaming
+    import dataset
+
+    # rank 0 downloads and caches the data, if needed, before the others read it
+    if rank == 0:
+        mnist = dataset.load(args.data_dir)
+    barrier.wait()
+    if rank != 0:
+        mnist = dataset.load(args.data_dir)
+    shard = mnist.train.shard(rank, n_workers, seed=rank)
+    local_batch = args.batch_size // n_workers
+
+    x = tf.placeholder(tf.float32, [None, n_steps, n_input], name='x-input')
+    y = tf.placeholder(tf.float32, [None, n_classes], name='y-input')
+    weights = {
+        'out': tf.get_variable('weights', shape=[args.hidden, n_classes], initializer=tf.random_normal_initializer())
+    }
+    biases = {
+        'out': tf.get_variable('biases', shape=[n_classes], initializer=tf.random_normal_initializer())
+    }
+    cell = models.build_cell(args.cell_type, args.hidden, args.layers)
+    pred = models.rnn_logits(x, cell, weights, biases)
+    cost = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(pred, y))
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        eval_cell = models.build_cell(args.cell_type, args.hidden, args.layers, training_mode=False)
+        pred_eval = models.rnn_logits(x, eval_cell, weights, biases)
+    accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(pred_eval, 1), tf.argmax(y, 1)), tf.float32))
+
+    optimizer = streaming.StreamingOptimizer(tf.train.AdamOptimizer(learning_rate=args.learning_rate))
+    grads_and_vars = [(g, v) for g, v in optimizer.compute_gradients(cost) if g is not None]
+    threads = args.threads_per_worker or max(1, mp.cpu_count() // n_workers)
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    test_data = mnist.test.images[:args.test_len].reshape((-1, n_steps, n_input))
+    test_label = mnist.test.labels[:args.test_len]
+
+    if n_workers == 1:
+        # the baseline: plain training steps, no buffers and no all-reduce
+        train_step = optimizer.apply_gradients(grads_and_vars)
+        sess = tf.Session(config=config)
+        sess.run(tf.global_variables_initializer())
+        for step in range(1, args.steps + 1):
+            if step == args.warmup + 1:
+                start = time.time()
+            batch_x, batch_y = shard.next_batch(local_batch)
+            batch_x = batch_x.reshape([local_batch, n_steps, n_input])
+            sess.run(train_step, feed_dict={x: batch_x, y: batch_y})
+        elapsed = time.time() - start
+        results.put({
+            'workers': 1,
+            'samples_per_s': (args.steps - args.warmup) * local_batch / elapsed,
+            'test_accuracy': float(sess.run(accuracy, feed_dict={x: test_data, y: test_label})),
+        })
+        sess.close()
+        return
+
+    grads = [g for g, _ in grads_and_vars]
+    trainable = [v for _, v in grads_and_vars]
+    grad_inputs = [tf.placeholder(tf.float32, v.get_shape()) for v in trainable]
+    apply_grads = optimizer.apply_gradients(list(zip(grad_inputs, trainable)))
+
+    # every streaming side without its final (see merge_stats) and its flag,
+    # which is raised on all workers alike; the buffers are exchanged as
+    # float32 values, their compensations (if any) included
+    sides = []
+    stat_inputs = []
+    assigns = []
+    for side, comps in zip(streaming.streaming_sites(), streaming.site_compensations()):
+        values = [streaming.read_buffer(side[i], comps[i]) for i in range(3)] + [tf.identity(side[4])]
+        inputs = [tf.placeholder(tf.float32, v.get_shape()) for v in values]
+        assigns += [streaming.assign_buffer(side[i], inputs[i], comps[i]) for i in range(3)]
+        assigns.append(side[4].assign(inputs[3]))
+        sides.append(tuple(values))
+        stat_inputs += inputs
+    stat_vars = [v for side in sides for v in side]
+    flat_sides = dict((side, Flattener(side)) for side in sides)
+    flat_grads = Flattener(trainable)
+    flat_stats = Flattener(stat_vars)
+    weight_inputs, assign_weights = assign_from_placeholders(trainable)
+    with tf.control_dependencies(assigns):
+        rebuild_finals = streaming.rebuild_final_statistics()
+
+    # row layout: [gradients (or weights at startup) | streaming statistics]
+    row_size = flat_grads.size + flat_stats.size
+    path = os.path.join(buffer_dir, 'rank%d.buf' % rank)
+    own = np.memmap(path, dtype=np.float64, mode='w+', shape=(row_size,))
+    barrier.wait()
+    rows = [own if r == rank else
+            np.memmap(os.path.join(buffer_dir, 'rank%d.buf' % r), dtype=np.float64, mode='r+', shape=(row_size,))
+            for r in range(n_workers)]
+    grad_sum = np.empty(flat_grads.size, dtype=np.float64)
+    merged_stats = np.empty(flat_stats.size, dtype=np.float64)
+
+    sess = tf.Session(config=config)
+    sess.run(tf.global_variables_initializer())
+
+    # start every worker from the weights of rank 0
+    if rank == 0:
+        flat_grads.flatten(sess.run(trainable), own)
+    barrier.wait()
+    if rank != 0:
+        values = flat_grads.unflatten(rows[0][:flat_grads.size])
+        sess.run(assign_weights, feed_dict=dict(zip(weight_inputs, values)))
+    barrier.wait()
+
+    compute_time = 0.0
+    reduce_time = 0.0
+    for step in range(1, args.steps + 1):
+        if step == args.warmup + 1:
+            start = time.time()
+            compute_time = reduce_time = 0.0
+
+        step_start = time.time()
+        batch_x, batch_y = shard.next_batch(local_batch)
+        batch_x = batch_x.reshape([local_batch, n_steps, n_input])
+        grad_values = sess.run(grads, feed_dict={x: batch_x, y: batch_y})
+        stat_values = sess.run(stat_vars)
+        flat_grads.flatten(grad_values, own[:flat_grads.size])
+        flat_stats.flatten(stat_values, own[flat_grads.size:])
+        reduce_start = time.time()
+        compute_time += reduce_start - step_start
+
+        barrier.wait()
+        grad_sum[...] = 0
+        for row in rows:
+            grad_sum += row[:flat_grads.size]
+        merge_stats([row[flat_grads.size:] for row in rows], sides, flat_sides, merged_stats)
+        # nobody writes its row again before everyone has read them
+        barrier.wait()
+        grad_sum /= n_workers
+        reduce_time += time.time() - reduce_start
+
+        feed = dict(zip(grad_inputs, flat_grads.unflatten(grad_sum)))
+        feed.update(zip(stat_inputs, flat_stats.unflatten(merged_stats)))
+        sess.run([apply_grads, rebuild_finals], feed_dict=feed)
+
+        if rank == 0 and args.display_step and step % args.display_step == 0:
+            acc = sess.run(accuracy, feed_dict={x: test_data, y: test_label})
+            print("Step %d, Testing Accuracy= %.5f" % (step, acc))
+
+    elapsed = time.time() - start
+    timed_steps = args.steps - args.warmup
+    if rank == 0:
+        results.put({
+            'workers': n_workers,
+            'samples_per_s': timed_steps * local_batch * n_workers / elapsed,
+            'compute_ms_per_step': 1000 * compute_time / timed_steps,
+            'allreduce_ms_per_step': 1000 * reduce_time / timed_steps,
+            'test_accuracy': float(sess.run(accuracy, feed_dict={x: test_data, y: test_label})),
+        })
+    sess.close()
+
+
+def run(n_workers, args):
+    """ Trains with n_workers processes and returns the result of rank 0 """
+    # /dev/shm keeps the buffers in memory where it exists
+    buffer_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    barrier = Barrier(n_workers)
+    results = mp.Queue()
+    procs = [mp.Process(target=worker, args=(rank, n_workers, args, buffer_dir, barrier, results))
+             for rank in range(n_workers)]
+    try:
+        for p in procs:
+            p.start()
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                # a dead worker would leave the others waiting at the barrier
+                if any(p.exitcode not in (None, 0) for p in procs):
+                    raise RuntimeError('a worker of the %d-process run failed' % n_workers)
+        for p in procs:
+            p.join()
+        return result
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        shutil.rmtree(buffer_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Data-parallel MNIST training over local processes.')
+    parser.add_argument('--workers', help='# worker processes', type=int, default=2)
+    parser.add_argument('--learning_rate', help='learning rate', type=float, default=0.001)
+    parser.add_argument('--steps', help='# training steps', type=int, default=200)
+    parser.add_argument('--warmup', help='# untimed steps at the start', type=int, default=10)
+    parser.add_argument('--batch_size', help='global batch size, split over the workers', type=int, default=128)
+    parser.add_argument('--hidden', help='# hidden units', type=int, default=50)
+    parser.add_argument('--layers', help='# layers', type=int, default=1)
+    parser.add_argument('--cell_type', help='type of RNN', choices=CELL_TYPES, default='SNGRU')
+    parser.add_argument('--threads_per_worker', help='tensorflow threads per worker (0: cores / workers)', type=int, default=0)
+    parser.add_argument('--display_step', help='# steps between test accuracies (0 to disable)', type=int, default=50)
+    parser.add_argument('--test_len', help='# test images for the accuracy', type=int, default=128)
+    parser.add_argument('--no_baseline', help='skip the plain single-process run', action='store_true')
+    parser.add_argument('--data_dir', help='MNIST directory', default='../data/')
+    args = parser.parse_args()
+
+    if args.batch_size % args.workers != 0:
+        parser.error('--batch_size must be divisible by --workers')
+    if args.steps <= args.warmup:
+        parser.error('--steps must be larger than --warmup')
+
+    baseline = None
+    if not args.no_baseline and args.workers > 1:
+        baseline = run(1, args)
+        print('1 worker: %.1f samples/s' % baseline['samples_per_s'])
+    result = run(args.workers, args)
+    print('%d workers: %.1f samples/s (compute %.2f ms/step, all-reduce %.2f ms/step), test accuracy %.5f' % (
+        args.workers, result['samples_per_s'], result['compute_ms_per_step'],
+        result['allreduce_ms_per_step'], result['test_accuracy']))
+    if baseline is not None:
+        speedup = result['samples_per_s'] / baseline['samples_per_s']
+        print('Speedup %.2fx, scaling efficiency %.1f%%' % (speedup, 100.0 * speedup / args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" Background input pipeline that prepares batches while the session runs """
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+
+class BatchPrefetcher(object):
+    """Prefetches batches of `dataset.next_batch` on a daemon thread.
+
+    Batches are copied into a ring of preallocated buffers of shape
+    [batch_size] + x_shape, so the training loop gets them ready to feed.
+    Up to `depth` batches are prepared ahead of the consumer.
+    """
+
+    def __init__(self, dataset, batch_size, x_shape, depth=2):
+        self._dataset = dataset
+        self._batch_size = batch_size
+        self._x_shape = [batch_size] + list(x_shape)
+        self._queue = queue.Queue(maxsize=depth)
+        # depth buffers in the queue, one being fed by the consumer, one being filled
+        self._ring = [(np.empty(self._x_shape, dtype=np.float32), None) for _ in range(depth + 2)]
+        self._stopped = threading.Event()
+
+        # seconds the consumer spent waiting for the last batch, and in total
+        self.last_wait = 0.0
+        self.total_wait = 0.0
+        self.batches = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        i = 0
+        try:
+            while not self._stopped.is_set():
+                batch_x, batch_y = self._dataset.next_batch(self._batch_size)
+                buf_x = self._ring[i][0]
+                np.copyto(buf_x, batch_x.reshape(self._x_shape))
+                self._put((buf_x, batch_y))
+                i = (i + 1) % len(self._ring)
+        except Exception as e:
+            # hand the error to the consumer instead of dying silently
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next_batch(self):
+        """ Returns the next (batch_x, batch_y); batch_x is reused after `depth` more calls """
+        start = time.time()
+        item = self._queue.get()
+        self.last_wait = time.time() - start
+        self.total_wait += self.last_wait
+        self.batches += 1
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def mean_wait(self):
+        return self.total_wait / max(self.batches, 1)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
@@ -0,0 +1,74 @@
+""" Step profiling: Chrome traces and time per op type / name scope from RunMetadata """
+
+import collections
+import os
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+# name scopes reported by default: the rnn cell parts and the streaming sites
+DEFAULT_SCOPES = ['Gates', 'Candidate', 'g_in', 'g_st', 'c_in', 'c_st', 'Stat_Bank', 'dau']
+
+
+def full_trace_options():
+    return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+
+
+def write_chrome_trace(run_metadata, path):
+    """ Writes the step as a Chrome trace, viewable at chrome://tracing """
+    trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+    with open(path, 'w') as f:
+        f.write(trace)
+
+
+def op_times(run_metadata, graph, scopes=DEFAULT_SCOPES):
+    """Aggregates the traced op times of one step.
+
+    Returns:
+      by_type: dict op type -> microseconds.
+      by_scope: dict scope -> microseconds of ops with a name component
+        starting with it (e.g. 'Gates' also counts 'Gates_1').
+      total: microseconds of all traced ops.
+    """
+    by_type = collections.defaultdict(int)
+    by_scope = collections.defaultdict(int)
+    total = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        # gpu ops are listed once per stream and again under stream:all
+        if dev_stats.device.endswith('/stream:all'):
+            continue
+        for node_stats in dev_stats.node_stats:
+            name = node_stats.node_name.split(':')[0]
+            micros = node_stats.all_end_rel_micros
+            try:
+                op_type = graph.get_operation_by_name(name).type
+            except KeyError:
+                # runtime-only nodes such as _SOURCE or _Recv
+                op_type = name
+            by_type[op_type] += micros
+            components = name.split('/')
+            for scope in scopes:
+                if any(c.startswith(scope) for c in components):
+                    by_scope[scope] += micros
+            total += micros
+    return by_type, by_scope, total
+
+
+def format_table(times, total, title, limit=15):
+    lines = ['%-30s %10s %7s' % (title, 'ms', '%')]
+    for key, micros in sorted(times.items(), key=lambda kv: -kv[1])[:limit]:
+        lines.append('%-30s %10.3f %6.1f%%' % (key, micros / 1000.0, 100.0 * micros / max(total, 1)))
+    return '\n'.join(lines)
+
+
+def report(run_metadata, graph, trace_dir, step, scopes=DEFAULT_SCOPES):
+    """ Writes the Chrome trace of a traced step and prints its op time tables """
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+    path = os.path.join(trace_dir, 'timeline_step%d.json' % step)
+    write_chrome_trace(run_metadata, path)
+
+    by_type, by_scope, total = op_times(run_metadata, graph, scopes)
+    print('Trace of step %d written to %s (%.3f ms of op time)' % (step, path, total / 1000.0))
+    print(format_table(by_type, total, 'op type'))
+    print(format_table(by_scope, total, 'name scope'))
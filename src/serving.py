@@ -0,0 +1,346 @@
+""" Step-wise serving of the GRU models with frozen streaming statistics.
+
+Clients send one timestep at a time for a session id and get back the
+read-out of that step. The engine keeps the recurrent state of every session
+and batches the steps of concurrent sessions into one session.run, up to
+max_batch_size steps or max_wait_ms after the first waiting step.
+
+  python serving.py --checkpoint ./inference/ --demo 16
+  python serving.py --checkpoint ./inference/ --port 5555
+
+The checkpoint is one saved by mnist.py --inference_dir (see checkpoint.py).
+"""
+
+import argparse
+import collections
+import json
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import numpy as np
+import tensorflow as tf
+
+import checkpoint
+import models
+
+SERVABLE_CELL_TYPES = ['SNGRU', 'LNGRU']
+
+
+class StepModel(object):
+    """One timestep of a trained RNN classifier, with the state fed in and out.
+
+    The variables are created under the same names as in mnist.py, so a
+    checkpoint of the training graph restores into it.
+    """
+
+    def __init__(self, cell_type, n_hidden, n_layers=1, n_input=28, n_classes=10,
+                 stat_bank=False, fused_matmul=False, checkpoint_dir=None):
+        self.n_hidden = n_hidden
+        self.n_layers = n_layers
+        self.n_input = n_input
+        self.graph = tf.Graph()
+        # read the checkpoint while the graph is being built
+        restorer = checkpoint.AsyncRestore(checkpoint_dir) if checkpoint_dir else None
+        with self.graph.as_default():
+            self.x = tf.placeholder(tf.float32, [None, n_input], name='x-step')
+            self.state = tuple(tf.placeholder(tf.float32, [None, n_hidden], name='state%d' % i)
+                               for i in range(n_layers))
+            weights = tf.get_variable('weights', shape=[n_hidden, n_classes], initializer=tf.random_normal_initializer())
+            biases = tf.get_variable('biases', shape=[n_classes], initializer=tf.random_normal_initializer())
+            cell = models.build_cell(cell_type, n_hidden, n_layers, training_mode=False,
+                                     stat_bank=stat_bank, fused_matmul=fused_matmul)
+            # the scope tf.nn.rnn / static_rnn put the cell variables in
+            with tf.variable_scope(models.RNN_SCOPE):
+                output, self.new_state = cell(models.project_inputs(self.x, cell), self.state)
+            self.logits = tf.matmul(output, weights) + biases
+            self.sess = tf.Session()
+            self.sess.run(tf.global_variables_initializer())
+            if restorer is not None and restorer.restore(self.sess) is None:
+                print('No checkpoint in %s, serving untrained weights' % checkpoint_dir)
+        self.graph.finalize()
+
+    def zero_state(self):
+        return [np.zeros(self.n_hidden, dtype=np.float32) for _ in range(self.n_layers)]
+
+    def step(self, x, states):
+        """ Runs one step for a batch: x is [batch, n_input], states a list per layer of [batch, n_hidden] """
+        feed = {self.x: x}
+        feed.update(zip(self.state, states))
+        return self.sess.run([self.logits, self.new_state], feed_dict=feed)
+
+
+class _Request(object):
+    def __init__(self, session_id, x):
+        self.session_id = session_id
+        self.x = x
+        # stamped by ServingEngine.step when queued
+        self.start = None
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class ServingEngine(object):
+    """Batches the steps of concurrent sessions on one background thread.
+
+    `step` blocks until the step of its session has been run. Two steps of
+    the same session are never put in one batch, as the second depends on the
+    state left by the first.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=2.0, history=10000):
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000.0
+        self._requests = queue.Queue()
+        self._deferred = collections.deque()
+        self._states = {}
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=history)
+        self._batch_sizes = collections.deque(maxlen=history)
+        self._steps = 0
+        self._start = time.time()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def step(self, session_id, x):
+        """ Runs one timestep x of shape [n_input] for the session; returns its logits """
+        request = _Request(session_id, np.asarray(x, dtype=np.float32).reshape(self._model.n_input))
+        request.start = time.time()
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def end_session(self, session_id):
+        with self._lock:
+            self._states.pop(session_id, None)
+
+    def _next_request(self, timeout):
+        if self._deferred:
+            return self._deferred.popleft()
+        return self._requests.get(timeout=timeout)
+
+    def _collect(self):
+        # block for the first step, then wait for more until max_wait after it
+        # was queued; deferred requests come first, so it is the oldest one
+        batch = [self._next_request(0.1)]
+        sessions = set([batch[0].session_id])
+        deferred = []
+        deadline = batch[0].start + self._max_wait
+        while len(batch) < self._max_batch_size:
+            try:
+                request = self._next_request(max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request.session_id in sessions:
+                deferred.append(request)
+            else:
+                batch.append(request)
+                sessions.add(request.session_id)
+        self._deferred.extend(deferred)
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                batch = self._collect()
+            except queue.Empty:
+                continue
+            try:
+                with self._lock:
+                    states = [self._states.get(r.session_id) or self._model.zero_state() for r in batch]
+                x = np.stack([r.x for r in batch])
+                layer_states = [np.stack([s[i] for s in states]) for i in range(self._model.n_layers)]
+                logits, new_states = self._model.step(x, layer_states)
+                with self._lock:
+                    for j, r in enumerate(batch):
+                        self._states[r.session_id] = [layer[j] for layer in new_states]
+                for j, r in enumerate(batch):
+                    r.output = logits[j]
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+            end = time.time()
+            with self._lock:
+                for r in batch:
+                    self._latencies.append(end - r.start)
+                self._batch_sizes.append(len(batch))
+                self._steps += len(batch)
+            for r in batch:
+                r.done.set()
+
+    def stats(self):
+        """ Latency percentiles (ms), throughput (steps/s) and mean batch size so far """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+            steps = self._steps
+            elapsed = time.time() - self._start
+        result = {
+            'steps': steps,
+            'steps_per_s': steps / elapsed,
+            'mean_batch_size': float(np.mean(batch_sizes)) if len(batch_sizes) else 0.0,
+        }
+        for p in (50, 90, 99):
+            result['p%d_ms' % p] = float(np.percentile(latencies, p)) if len(latencies) else 0.0
+        return result
+
+    def reset_stats(self):
+        with self._lock:
+            self._latencies.clear()
+            self._batch_sizes.clear()
+            self._steps = 0
+            self._start = time.time()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # one JSON object per line: {"session": id, "x": [...]} -> {"output": [...]},
+    # {"session": id, "end": true} -> {} and {"stats": true} -> engine stats
+    def handle(self):
+        engine = self.server.engine
+        for line in self.rfile:
+            request = json.loads(line.decode('utf-8'))
+            try:
+                if request.get('stats'):
+                    reply = engine.stats()
+                elif request.get('end'):
+                    engine.end_session(request['session'])
+                    reply = {}
+                else:
+                    reply = {'output': engine.step(request['session'], request['x']).tolist()}
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_tcp(engine, host='localhost', port=5555):
+    """ Serves the engine over TCP, one thread per connection; returns the server """
+    server = _Server((host, port), _Handler)
+    server.engine = engine
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class Client(object):
+    """ Line-delimited JSON client of serve_tcp """
+
+    def __init__(self, host='localhost', port=5555):
+        self._sock = socket.create_connection((host, port))
+        self._file = self._sock.makefile('rwb')
+
+    def _call(self, request):
+        self._file.write((json.dumps(request) + '\n').encode('utf-8'))
+        self._file.flush()
+        reply = json.loads(self._file.readline().decode('utf-8'))
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def step(self, session_id, x):
+        return np.array(self._call({'session': session_id, 'x': np.asarray(x).tolist()})['output'])
+
+    def end_session(self, session_id):
+        self._call({'session': session_id, 'end': True})
+
+    def stats(self):
+        return self._call({'stats': True})
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def demo(step_fns, n_steps, n_input, sequences):
+    """ Streams random sequences through concurrent clients, one thread per client """
+    def client(i, step_fn, end_fn):
+        rng = np.random.RandomState(i)
+        for s in range(sequences):
+            session_id = '%d-%d' % (i, s)
+            for t in range(n_steps):
+                step_fn(session_id, rng.rand(n_input))
+            end_fn(session_id)
+
+    threads = [threading.Thread(target=client, args=(i, step_fn, end_fn))
+               for i, (step_fn, end_fn) in enumerate(step_fns)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves an RNN one timestep at a time.')
+    parser.add_argument('--cell_type', choices=SERVABLE_CELL_TYPES, default='SNGRU')
+    parser.add_argument('--hidden', help='# hidden units', type=int, default=50)
+    parser.add_argument('--layers', help='# layers', type=int, default=1)
+    parser.add_argument('--classes', help='# classes', type=int, default=10)
+    parser.add_argument('--n_input', help='# inputs per timestep', type=int, default=28)
+    parser.add_argument('--stat_bank', action='store_true')
+    parser.add_argument('--fused_matmul', action='store_true')
+    parser.add_argument('--checkpoint', help='checkpoint directory, e.g. from mnist.py --inference_dir', default='')
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=2.0)
+    parser.add_argument('--port', help='serve on this localhost port (0: no server)', type=int, default=0)
+    parser.add_argument('--demo', help='# concurrent demo clients (0: no demo)', type=int, default=0)
+    parser.add_argument('--demo_tcp', help='run the demo clients over the localhost server', action='store_true')
+    parser.add_argument('--demo_sequences', help='# sequences per demo client', type=int, default=20)
+    parser.add_argument('--n_steps', help='# timesteps per demo sequence', type=int, default=28)
+    args = parser.parse_args()
+
+    model = StepModel(args.cell_type, args.hidden, args.layers, args.n_input, args.classes,
+                      stat_bank=args.stat_bank, fused_matmul=args.fused_matmul,
+                      checkpoint_dir=args.checkpoint or None)
+    engine = ServingEngine(model, args.max_batch_size, args.max_wait_ms)
+    server = serve_tcp(engine, port=args.port) if args.port or args.demo_tcp else None
+
+    if args.demo:
+        if args.demo_tcp:
+            clients = [Client(port=server.server_address[1]) for _ in range(args.demo)]
+            step_fns = [(c.step, c.end_session) for c in clients]
+        else:
+            step_fns = [(engine.step, engine.end_session)] * args.demo
+        engine.reset_stats()
+        demo(step_fns, args.n_steps, args.n_input, args.demo_sequences)
+        print(json.dumps(engine.stats()))
+        if args.demo_tcp:
+            for c in clients:
+                c.close()
+    if args.port:
+        print('Serving on localhost:%d' % server.server_address[1])
+        try:
+            while True:
+                time.sleep(10)
+                print(json.dumps(engine.stats()))
+        except KeyboardInterrupt:
+            pass
+    engine.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,117 +3,518 @@
 import tensorflow as tf
 from tensorflow.python.framework import ops
 import numpy as np
+import collections
+import contextlib
+import weakref
 
-def stream(x, name, training_mode=False):
+# the streamed statistics go through native graph ops by default; set to True to
+# route them through tf.py_func as before (needs a python callback on every run)
+use_py_func = False
+
+# names of the gradient functions registered so far, by the configuration they
+# were built from, so identical streaming sites share one registered gradient
+_registered_gradients = {}
+# forward and gradient-side streaming variables of every site, by graph and
+# variable scope; each side is [long, short, short_m2, final, short_counter, flag]
+_site_variables = weakref.WeakKeyDictionary()
+# their compensation buffers (or Nones), by graph and variable scope
+_site_compensations = weakref.WeakKeyDictionary()
+# last update op of each side of every site, by graph and (scope, side); every
+# new update of the same variables is made to run after it
+_site_last_updates = weakref.WeakKeyDictionary()
+
+# storage dtype of the activation-shaped streaming buffers (long, short,
+# short_m2 and final, on both sides); tf.float16 or tf.bfloat16 halve their
+# memory and bandwidth, the updates are still computed in float32. With
+# kahan_compensation each of them gets a compensation buffer of the same dtype
+# holding its rounding error. The compensated mode does NOT save memory: a
+# narrow buffer plus its compensation take exactly as many bytes (and as much
+# bandwidth) as the float32 buffer. It only brings back most of the precision,
+# and only where both halves are read together (read_buffer/assign_buffer);
+# it is for measuring what the rounding costs (check_precision.py reports
+# both). Without it, each update still computes in float32 and rounds once,
+# on the store. Set both before building the model, for training and eval
+# alike.
+storage_dtype = tf.float32
+kahan_compensation = False
+
+# ('record', list) or ('replay', iterator) while building inside recording() or
+# replaying()
+_tape = None
+# True while building inside unchained()
+_unchained = False
+# (scope, index) of the sites built inside unchained(), by graph; their
+# gradient side is not chained either
+_unchained_sites = weakref.WeakKeyDictionary()
+
+# collection of the "weights updated" flags of all streaming sites
+STREAMING_FLAGS = 'streaming_weight_updated_flags'
+
+# mixing of the long and short statistics into final, for the forward (ALPHA)
+# and the gradient side (BETA, whose third entry weighs in the raw gradient)
+ALPHA = [0,1]
+BETA = [0,0.3,0,7]
+
+def stream(x, name, training_mode=True, blocks=None, slot=None):
+    """Streams the statistic x through the streaming variables of scope name.
+
+    blocks: column sizes of separate statistics packed side by side in the
+      rows of a 2D x; every row of every block then decides its first update
+      of long on its own, as separate sites would (see update_streaming).
+    slot: (index, n_slots) to stream into one slot of variables shaped
+      [n_slots] + shape of x, e.g. for a StatBank.
+    """
     with tf.variable_scope(name) as scope:
+        index, n_slots = slot if slot is not None else (None, None)
+        x_shape = x.get_shape()
+        var_shape = x_shape if slot is None else [n_slots] + x_shape.as_list()
+        counter_shape = [] if slot is None else [n_slots]
+        # random initializers are not defined for every narrow dtype
+        final_init = None if storage_dtype == tf.float32 else tf.constant_initializer(0)
+        if not training_mode:
+            # inference: read the frozen statistic, no assigns and no gradient side
+            s_final  = tf.get_variable('s_final',shape=var_shape,dtype=storage_dtype,trainable=False,
+                                       initializer=final_init)
+            s_final_comp = _compensation('s_final', var_shape)
+            return tf.identity(_read(s_final, s_final_comp, index), name=name)
+
         # this should be the same as not doing any streaming things
-        alpha = [0,1]
-        beta = [0,0.3,0,7]
+        alpha = ALPHA
+        beta = BETA
         kappa = alpha * 2
-        x_shape = x.get_shape();
 
         # defining normstats streaming variables
-        s_long  = tf.get_variable('s_long',shape=x_shape,trainable=False,initializer=tf.constant_initializer(0))
-        s_short  = tf.get_variable('s_short',shape=x_shape,trainable=False,initializer=tf.constant_initializer(0))
-        s_final  = tf.get_variable('s_final',shape=x_shape,trainable=False)
-        s_short_counter  = tf.get_variable('s_short_counter',shape=[],trainable=False)
-        s_w_updated_flag  = tf.get_variable('s_w_updated_flag',shape=[],trainable=True,initializer=tf.constant_initializer(1))
-        g_w_updated_flag  = tf.get_variable('g_w_updated_flag',shape=[],trainable=True,initializer=tf.constant_initializer(1))
-
-        update_streaming(x,s_long,s_short,s_final,s_short_counter,s_w_updated_flag,alpha[0:2],kappa[0:2])
- 
-        x_revised = py_func_with_grad(lambda s: s, [s_final], [tf.float32], name=name, grad=lambda op,grad: stream_gradient(op,grad,name,beta,kappa))
-        # force some gradient onto the flags
-        x_revised = tf.add(x_revised, force_gradient(s_w_updated_flag,1))
-        x_revised = tf.add(x_revised, force_gradient(g_w_updated_flag,1))
+        dtype = storage_dtype
+        s_long  = tf.get_variable('s_long',shape=var_shape,dtype=dtype,trainable=False,initializer=tf.constant_initializer(0))
+        s_short  = tf.get_variable('s_short',shape=var_shape,dtype=dtype,trainable=False,initializer=tf.constant_initializer(0))
+        s_short_m2  = tf.get_variable('s_short_m2',shape=var_shape,dtype=dtype,trainable=False,initializer=tf.constant_initializer(0))
+        s_final  = tf.get_variable('s_final',shape=var_shape,dtype=dtype,trainable=False,initializer=final_init)
+        s_short_counter  = tf.get_variable('s_short_counter',shape=counter_shape,trainable=False,initializer=tf.constant_initializer(0))
+        # raised by StreamingOptimizer whenever the weights are updated
+        flag_collections = [tf.GraphKeys.GLOBAL_VARIABLES, STREAMING_FLAGS]
+        s_w_updated_flag  = tf.get_variable('s_w_updated_flag',shape=counter_shape,trainable=False,initializer=tf.constant_initializer(1),collections=flag_collections)
+        g_w_updated_flag  = tf.get_variable('g_w_updated_flag',shape=counter_shape,trainable=False,initializer=tf.constant_initializer(1),collections=flag_collections)
+
+        # same as with normstats but with gradients; created here so that every
+        # timestep of an unrolled rnn shares them with the forward pass
+        g_long  = tf.get_variable('g_long',shape=var_shape,dtype=dtype,trainable=False,initializer=tf.constant_initializer(0))
+        g_short = tf.get_variable('g_short',shape=var_shape,dtype=dtype,trainable=False,initializer=tf.constant_initializer(0))
+        g_short_m2 = tf.get_variable('g_short_m2',shape=var_shape,dtype=dtype,trainable=False,initializer=tf.constant_initializer(0))
+        g_final = tf.get_variable('g_final',shape=var_shape,dtype=dtype,trainable=False,initializer=final_init)
+        g_short_counter = tf.get_variable('g_short_counter',shape=counter_shape,trainable=False,initializer=tf.constant_initializer(0))
+        s_vars = [s_long, s_short, s_short_m2, s_final, s_short_counter, s_w_updated_flag]
+        g_vars = [g_long, g_short, g_short_m2, g_final, g_short_counter, g_w_updated_flag]
+        _site_variables.setdefault(tf.get_default_graph(), collections.OrderedDict())[scope.name] = (s_vars, g_vars)
+        s_comps = [_compensation(n, var_shape) for n in ['s_long', 's_short', 's_short_m2', 's_final']]
+        g_comps = [_compensation(n, var_shape) for n in ['g_long', 'g_short', 'g_short_m2', 'g_final']]
+        _site_compensations.setdefault(tf.get_default_graph(), collections.OrderedDict())[scope.name] = (s_comps, g_comps)
+
+        blocks = tuple(blocks) if blocks is not None else None
+        if _unchained:
+            _unchained_sites.setdefault(tf.get_default_graph(), set()).add((scope.name, index))
+        if _tape is not None and _tape[0] == 'replay':
+            # recomputation: reuse the statistic of the first build, don't update again
+            s_final_updated = next(_tape[1])
+        else:
+            s_final_updated = _chained((scope.name, 's', index), lambda: update_streaming(
+                x,s_long,s_short,s_short_m2,s_final,s_short_counter,s_w_updated_flag,alpha[0:2],kappa[0:2],s_comps,
+                index=index,blocks=blocks))
+            if _tape is not None:
+                # a value, not the variable, as later steps assign it again
+                s_final_updated = tf.identity(s_final_updated)
+                _tape[1].append(s_final_updated)
+
+        # forwardprops the streamed statistic, backprops the streamed gradient onto x
+        x_streamed = x + tf.stop_gradient(s_final_updated - x)
+        grad = _stream_grad(scope.name, beta, kappa, index, blocks)
+        key = ('stream', scope.name, tuple(beta), tuple(kappa), index, blocks)
+        if use_py_func:
+            x_revised = py_func_with_grad(lambda s: s, [x_streamed], [tf.float32], name=name, grad=grad, key=key)
+        else:
+            x_revised = identity_with_grad(x_streamed, name=name, grad=grad, key=key)
 
         # reshape because otherwise it breaks
         x_revised = tf.reshape(x_revised, x.get_shape())
         return x_revised
-    
 
-def stream_gradient(op, grad, name, beta, kappa):
-    with tf.variable_scope(name) as scope:
-        x = op.inputs[0]
 
-        # same as with normstats but with gradients
-        g_long  = get_variable('g_long',shape=x.get_shape(),trainable=False,initializer=tf.constant_initializer(0))
-        g_short = get_variable('g_short',shape=x.get_shape(),trainable=False,initializer=tf.constant_initializer(0))
-        g_final = get_variable('g_final',shape=x.get_shape(),trainable=False)
-        g_short_counter = get_variable('g_short_counter',shape=[],trainable=False, initializer=tf.constant_initializer(0))
-        g_w_updated_flag  = get_variable('g_w_updated_flag',shape=[],trainable=True, initializer=tf.constant_initializer(1))
+def _compensation(name, shape):
+    # compensation buffer of a narrow streaming buffer, if enabled
+    if not kahan_compensation or storage_dtype == tf.float32:
+        return None
+    return tf.get_variable(name + '_comp', shape=shape, dtype=storage_dtype, trainable=False,
+                           initializer=tf.constant_initializer(0))
+
+
+@contextlib.contextmanager
+def recording(tape):
+    """ Appends the forward statistic of every stream() built inside to the list tape """
+    global _tape
+    previous, _tape = _tape, ('record', tape)
+    try:
+        yield tape
+    finally:
+        _tape = previous
+
+
+@contextlib.contextmanager
+def unchained():
+    """Builds the stream() calls inside, and later their gradients, without
+    chaining their updates to the previous ones of the same site (see
+    _chained). For the body of a while loop (dynamic_rnn), whose ops cannot
+    depend on ops outside of it; the loop has to run one iteration at a time
+    instead.
+    """
+    global _unchained
+    previous, _unchained = _unchained, True
+    try:
+        yield
+    finally:
+        _unchained = previous
+
+
+@contextlib.contextmanager
+def replaying(tape):
+    """Makes the stream() calls built inside use the statistics of tape, in
+    order, instead of updating the streaming variables a second time.
+
+    For recomputing a part of the graph recorded with recording(): the forward
+    side is updated once by the first build, and only the gradients of the
+    recomputed part run the gradient side.
+    """
+    global _tape
+    previous, _tape = _tape, ('replay', iter(tape))
+    try:
+        yield
+    finally:
+        _tape = previous
+
+
+def streaming_sites(graph=None):
+    """ Lists the [long, short, short_m2, final, short_counter, flag] variables of
+    the forward and the gradient side of every streaming site in the graph """
+    sites = _site_variables.get(graph or tf.get_default_graph(), {})
+    return [side for s_vars, g_vars in sites.values() for side in (s_vars, g_vars)]
+
+
+def site_compensations(graph=None):
+    """ The compensation buffers (or Nones) of long, short, short_m2 and final of
+    every side listed by streaming_sites, in the same order """
+    comps = _site_compensations.get(graph or tf.get_default_graph(), {})
+    return [side for s_comps, g_comps in comps.values() for side in (s_comps, g_comps)]
+
+
+def read_buffer(v, comp=None):
+    """ float32 value of a streaming buffer, with its compensation added back """
+    return _read(v, comp)
+
+
+def assign_buffer(v, value, comp=None):
+    """ Assigns a float32 value to a streaming buffer and its compensation """
+    return _store(v, value, comp)
+
+
+def frozen_statistics(graph=None):
+    """ The s_final variable (and its compensation, if any) of every site: all
+    that the inference graph reads """
+    graph = graph or tf.get_default_graph()
+    sites = _site_variables.get(graph, {})
+    comps = _site_compensations.get(graph, {})
+    frozen = []
+    for scope_name, (s_vars, g_vars) in sites.items():
+        frozen.append(s_vars[3])
+        if comps[scope_name][0][3] is not None:
+            frozen.append(comps[scope_name][0][3])
+    return frozen
+
+
+def rebuild_final_statistics(graph=None):
+    """ Op recomputing the forward s_final of every site from its long and short
+    statistics, e.g. after those were assigned from outside the graph """
+    graph = graph or tf.get_default_graph()
+    sites = _site_variables.get(graph, {})
+    comps = _site_compensations.get(graph, {})
+    updates = []
+    for scope_name, (s_vars, g_vars) in sites.items():
+        s_long, s_short, _, s_final = s_vars[:4]
+        c_long, c_short, _, c_final = comps[scope_name][0]
+        final = _read(s_long, c_long)*ALPHA[0] + _read(s_short, c_short)*ALPHA[1]
+        updates.append(_store(s_final, final, c_final))
+    return tf.group(*updates)
+
+
+def flag_weights_updated(name='flag_weights_updated'):
+    """ Op raising the weight-updated flag of every streaming site in the graph """
+    # the flags of a StatBank have one entry per slot
+    return tf.group(*[f.assign(tf.ones(f.get_shape())) for f in tf.get_collection(STREAMING_FLAGS)], name=name)
+
+
+class StreamingOptimizer(object):
+    """Wraps an optimizer so that applying gradients also raises the
+    weight-updated flags of all streaming sites, in one grouped op.
+
+    Build the model before calling apply_gradients/minimize, so that all
+    flags are in the graph.
+    """
 
-        update_streaming(grad,g_long,g_short,g_final,g_short_counter,g_w_updated_flag,beta[0:2],kappa[2:4])
+    def __init__(self, optimizer):
+        self._optimizer = optimizer
 
-        # final g to use based on streaming norm gradient update equation
-        g_combined = g_final + beta[2] * grad
+    def compute_gradients(self, *args, **kwargs):
+        return self._optimizer.compute_gradients(*args, **kwargs)
 
-        # assign this final value to g_final
-        g_final.assign(g_combined)
-        return tf.convert_to_tensor(g_combined)
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        apply_op = self._optimizer.apply_gradients(grads_and_vars, global_step=global_step, name=name)
+        # the flags only go up once the new weights are in place
+        with tf.control_dependencies([apply_op]):
+            return flag_weights_updated()
 
+    def minimize(self, loss, global_step=None, var_list=None, name=None):
+        grads_and_vars = self.compute_gradients(loss, var_list=var_list)
+        return self.apply_gradients(grads_and_vars, global_step=global_step, name=name)
 
+    def __getattr__(self, name):
+        return getattr(self._optimizer, name)
 
-def update_streaming(x, v_long, v_short, v_final, v_short_counter,v_w_updated_flag, alpha_beta, kappa):
+
+class StatBank(object):
+    """One set of streaming variables for the statistics of several cells, e.g.
+    of all the layers of a model, each streaming into its own slot.
+
+    The buffers are shaped [n_slots] + the shape of the packed statistic and
+    are created in the variable scope of the first stream_bank call of each
+    graph; the counters and weight-updated flags have one entry per slot.
+    Each slot is still updated by its own chain per step: the statistics of a
+    layer depend on the normalized output of the layer below, so the slots of
+    one step cannot be updated by a single op.
+    """
+
+    def __init__(self, n_slots, name='Stat_Bank'):
+        self.n_slots = n_slots
+        self.name = name
+        # variable scope holding the bank, by graph
+        self._scopes = weakref.WeakKeyDictionary()
+
+
+def stream_bank(xs, bank, index, training_mode=True):
+    """Streams several [k, n_i] statistics through slot index of bank, packed
+    side by side as one [k, sum(n_i)] statistic updated by a single chain.
+
+    Within the slot, the statistics share one short counter and one
+    weight-updated flag: all of them get exactly one sample per update and
+    their flags are raised together, so separate ones would always be equal.
+    Each row of each statistic checks for its first update of long on its own.
+    """
+    sizes = [x.get_shape()[1].value for x in xs]
+    graph = tf.get_default_graph()
+    scope = bank._scopes.get(graph)
+    if scope is None:
+        scope = bank._scopes[graph] = tf.get_variable_scope()
+        reuse = None
+    else:
+        # e.g. a later timestep or another layer
+        reuse = True
+    with tf.variable_scope(scope, reuse=reuse):
+        packed = stream(tf.concat(1, xs), bank.name, training_mode, blocks=sizes, slot=(index, bank.n_slots))
+    offsets = np.cumsum([0] + sizes)
+    return [tf.slice(packed, [0, int(offsets[i])], [-1, sizes[i]]) for i in range(len(xs))]
+
+
+def _stream_grad(scope_name, beta, kappa, index=None, blocks=None):
+    # looks the variables up from the graph of the op, so the registered function
+    # stays valid when the model is built again in a new graph
+    def stream_grad(op, grad):
+        g_vars = _site_variables[op.graph][scope_name][1]
+        g_comps = _site_compensations[op.graph][scope_name][1]
+        return _chained((scope_name, 'g', index), lambda: stream_gradient(
+            op, grad, g_vars, beta, kappa, g_comps, index, blocks))
+    return stream_grad
+
+
+def _chained(key, build_update):
+    """Builds one update of a side of a site after the previous one.
+
+    Every timestep of an unrolled rnn reads and assigns the same variables;
+    the steps of input-side sites only depend on x_t and the weights, so
+    without this their read-modify-write chains would run concurrently and
+    lose updates. The sites of a while loop (built inside unchained()) are
+    not chained; there the loop runs one iteration at a time instead (see
+    models.rnn_window_logits).
+    """
+    graph = tf.get_default_graph()
+    scope_name, _, index = key
+    if (scope_name, index) in _unchained_sites.get(graph, ()):
+        return build_update()
+    last_updates = _site_last_updates.setdefault(graph, {})
+    previous = last_updates.get(key)
+    with tf.control_dependencies([previous] if previous is not None else []):
+        updated = build_update()
+    last_updates[key] = updated.op
+    return updated
+
+
+def stream_gradient(op, grad, g_vars, beta, kappa, g_comps=None, index=None, blocks=None):
+    g_long, g_short, g_short_m2, g_final, g_short_counter, g_w_updated_flag = g_vars
+
+    g_final_updated = update_streaming(grad,g_long,g_short,g_short_m2,g_final,g_short_counter,g_w_updated_flag,beta[0:2],kappa[2:4],g_comps,
+                                       index=index,blocks=blocks)
+
+    # final g to use based on streaming norm gradient update equation
+    g_combined = g_final_updated + beta[2] * grad
+
+    # assign this final value to g_final
+    return tf.convert_to_tensor(_store(g_final, g_combined, g_comps[3] if g_comps else None, index))
+
+
+
+def update_streaming(x, v_long, v_short, v_short_m2, v_final, v_short_counter,v_w_updated_flag, alpha_beta, kappa, comps=None,
+                     index=None, blocks=None):
+    """ Runs one streaming step on x and returns the updated final statistic.
+    The short window is kept as (count, mean, M2), so windows of several workers
+    can be merged exactly (see streaming_np.merge). The arithmetic is float32
+    whatever the storage dtype of the buffers; comps are the optional
+    compensation buffers of long, short, short_m2 and final. With index, the
+    variables have a leading slot axis and only that slot is read and updated.
+    With blocks (see stream), every row of every block of columns checks on
+    its own whether long was set before, instead of the whole statistic
+    going by its first element. """
     x = tf.stop_gradient(x)
-    proceed = True
     zero = tf.constant(0.0)
-    zero_short = tf.constant(0.0, shape=v_short.get_shape())
     one = tf.constant(1.0)
-    true = tf.constant(True, dtype=tf.bool)
-    false = tf.constant(False, dtype=tf.bool)
-    if proceed:
-        # update short variable
-        v_short.assign(v_short*v_short_counter + x)
-
-        def update_long():
-            def update_first():
-                #print 'first update'
-                return v_long.assign(v_short)
-            def update_rest():
-                #print 'not first update'
-                return v_long.assign(v_long*kappa[0] + v_short*kappa[1])
+    c_long, c_short, c_short_m2, c_final = comps or [None] * 4
+
+    def update_long():
+        def update_first():
+            return _store(v_long, _read(v_short, c_short, index), c_long, index)
+        def update_rest():
+            return _store(v_long, _read(v_long, c_long, index)*kappa[0] + _read(v_short, c_short, index)*kappa[1], c_long, index)
 
+        if blocks is None:
             # check whether long has been updated before by seeing if it's equal to 0
-            v_long_is_0 = tf.equal(v_long, zero)[0][0]
-            tf.cond(v_long_is_0, update_first, update_rest)
+            v_long_is_0 = tf.equal(_read(v_long, c_long, index), zero)[0][0]
+            long_updated = tf.cond(v_long_is_0, update_first, update_rest)
+        else:
+            long_val = _read(v_long, c_long, index)
+            short_val = _read(v_short, c_short, index)
+            first = _first_in_block(long_val, blocks)
+            rest = long_val*kappa[0] + short_val*kappa[1]
+            long_updated = _store(v_long, first*short_val + (1 - first)*rest, c_long, index)
 
+        with tf.control_dependencies([long_updated]):
             # now the weight has been updated, assign 0 to the flag
-            v_w_updated_flag.assign(zero)
+            flag_reset = _assign(v_w_updated_flag, zero, index)
+        with tf.control_dependencies([flag_reset]):
+            # and start a new, empty short window
+            return tf.identity(long_updated), tf.zeros_like(x), tf.zeros_like(x), tf.identity(zero)
 
-            # reset weight of short variable to 0
-            v_short.assign(zero_short)
-            #print 'assigned 0 to short'
-            return true
+    def keep_long():
+        return (_read(v_long, c_long, index), _read(v_short, c_short, index), _read(v_short_m2, c_short_m2, index),
+                _read(v_short_counter, index=index))
 
-        # check if weight has been updated; if so, update, if not, don't do anything
-        tf.cond(tf.equal(v_w_updated_flag, one), update_long, lambda: true)
-        #print 'assigning more stuff'
-        v_short_counter_updated = v_short_counter.assign_add(1)
-        v_short.assign(v_short / v_short_counter_updated)
+    # check if weight has been updated; if so, fold the short window into long
+    long_val, mean, m2, count = tf.cond(tf.equal(_read(v_w_updated_flag, index=index), one), update_long, keep_long)
 
-        v_final.assign(v_long*alpha_beta[0] + v_short*alpha_beta[1])
+    # add x to the short window (Welford)
+    count = count + 1
+    delta = x - mean
+    mean = mean + delta / count
+    m2 = m2 + delta * (x - mean)
+    updates = [_assign(v_short_counter, count, index), _store(v_short, mean, c_short, index),
+               _store(v_short_m2, m2, c_short_m2, index)]
 
+    with tf.control_dependencies(updates):
+        return _store(v_final, long_val*alpha_beta[0] + mean*alpha_beta[1], c_final, index)
 
-# define gradient of a python function
-def py_func_with_grad(func, inp, Tout, stateful=True, name=None, grad=None):
+
+def _first_in_block(long_val, blocks):
+    # 1.0 where the first element of the row and block of columns of an element
+    # of the [rows, sum(blocks)] long_val is 0, i.e. long was never set, else 0.0
+    rows = long_val.get_shape()[0].value
+    columns = sum(blocks)
+    starts = np.repeat(np.cumsum([0] + list(blocks[:-1])), blocks)
+    firsts = (np.arange(rows)[:, None] * columns + starts[None, :]).astype(np.int32)
+    return tf.cast(tf.equal(tf.gather(tf.reshape(long_val, [-1]), firsts), 0.0), tf.float32)
+
+
+def _read(v, comp=None, index=None):
+    # float32 value of a streaming buffer (or of its slot index), plus its
+    # compensation if it has one
+    if index is not None:
+        v = tf.gather(v, index)
+        comp = tf.gather(comp, index) if comp is not None else None
+    if v.dtype.base_dtype == tf.float32:
+        return tf.identity(v)
+    value = tf.cast(v, tf.float32)
+    if comp is not None:
+        value = value + tf.cast(comp, tf.float32)
+    return value
+
+
+def _assign(v, value, index=None):
+    # assigns the variable, or only its slot index
+    if index is None:
+        return v.assign(value)
+    return tf.scatter_update(v, [index], tf.expand_dims(value, 0))
+
+
+def _store(v, value, comp=None, index=None):
+    """ Assigns the float32 value to a streaming buffer (or to its slot index)
+    and returns the value once assigned. With a compensation buffer, the
+    rounding error of the narrow storage is kept there (as in Kahan summation)
+    and added back on reads. """
+    if v.dtype.base_dtype == tf.float32 and index is None:
+        return v.assign(value)
+    stored = tf.cast(value, v.dtype.base_dtype)
+    updates = [_assign(v, stored, index)]
+    if comp is not None:
+        updates.append(_assign(comp, tf.cast(value - tf.cast(stored, tf.float32), comp.dtype.base_dtype), index))
+    with tf.control_dependencies(updates):
+        return tf.identity(value)
+
+
+def _register_gradient(grad, key=None):
+    # gradients built from the same configuration are only registered once
+    if key is not None:
+        if key not in _registered_gradients:
+            name = 'StreamingGrad' + str(len(_registered_gradients))
+            tf.RegisterGradient(name)(grad)
+            _registered_gradients[key] = name
+        return _registered_gradients[key]
+
+    # Need to generate a unique name to avoid duplicates:
     num = []
     for i in range(100):
         num.append(str(np.random.randint(0,10)))
     rnd_name = 'PyFuncGrad' + ''.join(num)
     tf.RegisterGradient(rnd_name)(grad)
+    return rnd_name
+
+# define gradient of a python function
+def py_func_with_grad(func, inp, Tout, stateful=True, name=None, grad=None, key=None):
+    rnd_name = _register_gradient(grad, key)
     g = tf.get_default_graph()
     with g.gradient_override_map({"PyFunc": rnd_name}):
         return tf.py_func(func, inp, Tout, stateful=stateful, name=name)
 
+# define gradient of an identity op; unlike py_func it stays in the graph, so no
+# python callback runs per step and the graph can be serialized
+def identity_with_grad(x, name=None, grad=None, key=None):
+    rnd_name = _register_gradient(grad, key)
+    g = tf.get_default_graph()
+    with g.gradient_override_map({"Identity": rnd_name}):
+        return tf.identity(x, name=name)
+
 # force a gradient to be considered in computation graph
 def force_gradient(x,mag,name='force_grad'):
     # this op forwardprops 0, backprops mag
-    return py_func_with_grad(lambda x: np.float32(0),[x],[tf.float32],name=name,grad=lambda op, grad: force_grad_backprop(op,grad,mag))
+    grad = lambda op, grad: force_grad_backprop(op,grad,mag)
+    key = ('force', mag)
+    if use_py_func:
+        return py_func_with_grad(lambda x: np.float32(0),[x],[tf.float32],name=name,grad=grad,key=key)
+    return identity_with_grad(x - tf.stop_gradient(x),name=name,grad=grad,key=key)
 
 # forace that gradient to be 0
 def force_grad_backprop(op,grad,mag):
     # backprop a constant gradient
     x = op.inputs[0]
     return x*0+mag
-
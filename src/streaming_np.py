@@ -0,0 +1,161 @@
+""" NumPy reference of streaming.update_streaming for offline replay of streaming statistics """
+
+import numpy as np
+
+
+class StreamingStats(object):
+    """Streaming statistics of many independent streams, updated in place.
+
+    Mirrors one streaming site of `streaming.stream` per stream: the long
+    accumulator, the short window kept as (counter, mean, M2), the
+    weight-updated flag and the alpha(beta)/kappa mixing of `update_streaming`.
+    All buffers are allocated once, so `update` does no allocation on the
+    activation-sized arrays.
+    """
+
+    def __init__(self, n_streams, feature_shape, alpha_beta=(0, 1), kappa=(0, 1), dtype=np.float32):
+        """
+        Args:
+          n_streams: int, number of independent streams (e.g. sites or models).
+          feature_shape: int or tuple, shape of the statistic of one stream.
+          alpha_beta: mixing of long and short into the final statistic.
+          kappa: mixing of old long and short into the new long statistic.
+          dtype: dtype of all buffers; float32 matches the graph.
+        """
+        if isinstance(feature_shape, int):
+            feature_shape = (feature_shape,)
+        self.n_streams = n_streams
+        self.feature_shape = tuple(feature_shape)
+        n_features = int(np.prod(self.feature_shape))
+        self.alpha_beta = alpha_beta
+        self.kappa = kappa
+
+        shape = (n_streams, n_features)
+        self.long = np.zeros(shape, dtype=dtype)
+        self.short = np.zeros(shape, dtype=dtype)
+        self.m2 = np.zeros(shape, dtype=dtype)
+        self.final = np.zeros(shape, dtype=dtype)
+        self.counter = np.zeros(n_streams, dtype=dtype)
+        # streams start with the flag raised, as the graph variables do
+        self.flag = np.ones(n_streams, dtype=dtype)
+
+        # scratch buffers reused by every update
+        self._delta = np.empty(shape, dtype=dtype)
+        self._rest = np.empty(shape, dtype=dtype)
+        self._mix = np.empty(shape, dtype=dtype)
+        self._updated = np.empty(n_streams, dtype=bool)
+        self._first = np.empty(n_streams, dtype=bool)
+        self._not_first = np.empty(n_streams, dtype=bool)
+
+    def mark_weights_updated(self, streams=None):
+        """ Raises the weight-updated flag, as an optimizer step does for the graph """
+        if streams is None:
+            self.flag.fill(1)
+        else:
+            self.flag[streams] = 1
+
+    def update(self, x):
+        """Runs one streaming step on x of shape [n_streams] + feature_shape.
+
+        Returns a view of the final statistic, shaped like x; it is overwritten
+        by the next update.
+        """
+        x = np.asarray(x).reshape(self.short.shape)
+        counter = self.counter[:, None]
+
+        # streams whose weights were updated fold their short window into long;
+        # the first time (long still 0) long is just set to short
+        np.equal(self.flag, 1, out=self._updated)
+        np.equal(self.long[:, 0], 0, out=self._first)
+        np.logical_not(self._first, out=self._not_first)
+        np.logical_and(self._first, self._updated, out=self._first)
+        np.logical_and(self._not_first, self._updated, out=self._not_first)
+
+        np.multiply(self.long, self.kappa[0], out=self._rest)
+        np.multiply(self.short, self.kappa[1], out=self._mix)
+        np.add(self._rest, self._mix, out=self._rest)
+        np.copyto(self.long, self.short, where=self._first[:, None])
+        np.copyto(self.long, self._rest, where=self._not_first[:, None])
+
+        # now the weight has been updated, reset the flag and start a new short window
+        np.copyto(self.flag, 0, where=self._updated)
+        np.copyto(self.counter, 0, where=self._updated)
+        np.copyto(self.short, 0, where=self._updated[:, None])
+        np.copyto(self.m2, 0, where=self._updated[:, None])
+
+        # add x to the short window (Welford)
+        self.counter += 1
+        np.subtract(x, self.short, out=self._delta)
+        np.divide(self._delta, counter, out=self._mix)
+        np.add(self.short, self._mix, out=self.short)
+        np.subtract(x, self.short, out=self._mix)
+        np.multiply(self._delta, self._mix, out=self._mix)
+        np.add(self.m2, self._mix, out=self.m2)
+
+        self._update_final()
+        return self.final.reshape((self.n_streams,) + self.feature_shape)
+
+    def _update_final(self):
+        np.multiply(self.long, self.alpha_beta[0], out=self.final)
+        np.multiply(self.short, self.alpha_beta[1], out=self._mix)
+        np.add(self.final, self._mix, out=self.final)
+
+    def replay(self, xs, weight_update_every=1, out=None):
+        """Replays a logged sequence xs of shape [T, n_streams] + feature_shape.
+
+        The weight-updated flag is raised before every `weight_update_every`-th
+        step, as a training loop would. Returns the final statistic after every
+        step, written into `out` if given.
+        """
+        xs = np.asarray(xs)
+        if out is None:
+            out = np.empty(xs.shape, dtype=self.final.dtype)
+        for t in range(xs.shape[0]):
+            if weight_update_every and t > 0 and t % weight_update_every == 0:
+                self.mark_weights_updated()
+            out[t] = self.update(xs[t])
+        return out
+
+
+def merge(states):
+    """Merges the StreamingStats of several workers into a new one.
+
+    The short windows are combined exactly with the pairwise update of Chan et
+    al. on (counter, mean, M2); long is averaged, which is exact when the
+    workers are merged after every step and so share the same long. All states
+    must have the same layout and mixing.
+    """
+    first = states[0]
+    merged = StreamingStats(first.n_streams, first.feature_shape, first.alpha_beta, first.kappa,
+                            dtype=first.short.dtype)
+    counter, short, m2 = merge_windows([s.counter for s in states], [s.short for s in states],
+                                       [s.m2 for s in states])
+    merged.counter[...] = counter
+    merged.short[...] = short
+    merged.m2[...] = m2
+    merged.long[...] = np.mean([s.long for s in states], axis=0)
+    merged.flag[...] = np.max([s.flag for s in states], axis=0)
+    merged._update_final()
+    return merged
+
+
+def merge_windows(counters, means, m2s):
+    """Merges short windows given as per-worker (counter, mean, M2) arrays.
+
+    counters[i] has shape [n_streams] (or is a scalar) and means[i], m2s[i]
+    have shape [n_streams, ...]. Returns the merged (counter, mean, M2).
+    """
+    counter = np.array(counters[0], dtype=np.float64)
+    mean = np.array(means[0], dtype=np.float64)
+    m2 = np.array(m2s[0], dtype=np.float64)
+    for n_b, mean_b, m2_b in zip(counters[1:], means[1:], m2s[1:]):
+        n_a = counter.reshape(counter.shape + (1,) * (mean.ndim - counter.ndim))
+        n_b = np.reshape(n_b, n_a.shape)
+        n = n_a + n_b
+        # weight of the other window; 0 where both windows are empty
+        w_b = np.where(n > 0, n_b / np.maximum(n, 1), 0)
+        delta = mean_b - mean
+        mean += delta * w_b
+        m2 += m2_b + delta * delta * n_a * w_b
+        counter = counter + np.reshape(n_b, counter.shape)
+    return counter, mean, m2
@@ -0,0 +1,101 @@
+""" Checks the RNN builders of models.py against each other.
+
+  python -m unittest test_models
+"""
+
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+import models
+import streaming
+
+
+def train_step(x_value, y_value, n_hidden, recompute_segment, values=None):
+    """Builds a small one-layer SNGRU classifier and runs its gradients once.
+
+    With recompute_segment > 0 through models.checkpointed_rnn, else by
+    differentiating models.rnn_logits. values (by variable name) are assigned
+    before the run. Returns the gradients and the streaming variables after
+    the run, by variable name, and the initial values of all variables.
+    """
+    n_steps, n_input = x_value.shape[1:]
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, [None, n_steps, n_input])
+        y = tf.placeholder(tf.float32, [None, y_value.shape[1]])
+        weights = {'out': tf.get_variable('weights', shape=[n_hidden, y_value.shape[1]])}
+        biases = {'out': tf.get_variable('biases', shape=[y_value.shape[1]])}
+        cell = models.build_cell('SNGRU', n_hidden)
+        cost_fn = lambda logits: tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits, y))
+        if recompute_segment > 0:
+            _, _, grads_and_vars, _ = models.checkpointed_rnn(x, cell, weights, biases, cost_fn, recompute_segment)
+        else:
+            pred = models.rnn_logits(x, cell, weights, biases)
+            grads_and_vars = tf.train.GradientDescentOptimizer(0.1).compute_gradients(cost_fn(pred))
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        stats = [v for side in streaming.streaming_sites() for v in side]
+        variables = tf.global_variables()
+        inputs = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in variables]
+        assign = tf.group(*[v.assign(p) for v, p in zip(variables, inputs)])
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if values is not None:
+                sess.run(assign, feed_dict=dict((p, values[v.name]) for v, p in zip(variables, inputs)))
+            initial = dict(zip([v.name for v in variables], sess.run(variables)))
+            grad_values = sess.run([g for g, _ in grads_and_vars], feed_dict={x: x_value, y: y_value})
+            grads = dict((v.name, g) for (_, v), g in zip(grads_and_vars, grad_values))
+            stat_values = dict(zip([v.name for v in stats], sess.run(stats)))
+    return grads, stat_values, initial
+
+
+class CheckpointedRNNTest(unittest.TestCase):
+
+    def test_recomputed_gradients_match(self):
+        rng = np.random.RandomState(0)
+        x_value = rng.rand(8, 12, 5).astype(np.float32)
+        y_value = np.eye(3, dtype=np.float32)[rng.randint(0, 3, 8)]
+        grads, stats, initial = train_step(x_value, y_value, 16, 0)
+        for segment in (1, 4, 5):
+            recomputed_grads, recomputed_stats, _ = train_step(x_value, y_value, 16, segment, initial)
+            self.assertEqual(sorted(grads), sorted(recomputed_grads))
+            for name in grads:
+                np.testing.assert_allclose(recomputed_grads[name], grads[name], rtol=1e-4, atol=1e-5,
+                                           err_msg='%s, segments of %d' % (name, segment))
+            # forward (s_*) and gradient (g_*) sides alike: each updated once per step
+            self.assertEqual(sorted(stats), sorted(recomputed_stats))
+            for name in stats:
+                np.testing.assert_allclose(recomputed_stats[name], stats[name], rtol=1e-4, atol=1e-5,
+                                           err_msg='%s, segments of %d' % (name, segment))
+
+
+class LNLSTMProjectionTest(unittest.TestCase):
+
+    def test_projected_output_and_clipped_state(self):
+        batch, n_steps, n_input, n_hidden, num_proj, clip = 4, 6, 5, 8, 3, 0.05
+        rng = np.random.RandomState(0)
+        x_value = 10 * rng.randn(batch, n_steps, n_input).astype(np.float32)
+        with tf.Graph().as_default():
+            x = tf.placeholder(tf.float32, [None, n_steps, n_input])
+            weights = {'out': tf.get_variable('weights', shape=[num_proj, 2])}
+            biases = {'out': tf.get_variable('biases', shape=[2])}
+            cell = models.build_cell('LNLSTM', n_hidden, 2, num_proj=num_proj, proj_clip=clip, ln_proj=True)
+            self.assertEqual(cell.output_size, num_proj)
+            logits, state = models.rnn_window_logits(x, cell, None, weights, biases)
+            # the recurrent matmul reads the projected state
+            recurrent = [v for v in tf.trainable_variables() if '/out_2/' in v.name]
+            self.assertEqual([v.get_shape().as_list() for v in recurrent], [[num_proj, 4 * n_hidden]] * 2)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                logits_value, state_value = sess.run([logits, state], feed_dict={x: x_value})
+        self.assertEqual(logits_value.shape, (batch, 2))
+        for c, m in state_value:
+            self.assertEqual(c.shape, (batch, n_hidden))
+            self.assertEqual(m.shape, (batch, num_proj))
+            self.assertLessEqual(np.abs(m).max(), clip + 1e-7)
+
+
+if __name__ == '__main__':
+    unittest.main()
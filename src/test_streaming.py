@@ -0,0 +1,103 @@
+""" Checks the streaming statistics of the graph against the NumPy reference.
+
+  python -m unittest test_streaming
+"""
+
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+import layers
+import streaming
+import streaming_np
+
+
+def run_site(sequences, shape):
+    """Streams the sequences through one input-side site unrolled over their
+    timesteps, raising the weight-updated flag before each but the first.
+
+    The updates of the steps only depend on their own x_t, so any race
+    between them shows up as a mismatch. Returns the streamed statistic of
+    every step of every sequence and the final streaming variables.
+    """
+    n_steps = len(sequences[0])
+    graph = tf.Graph()
+    with graph.as_default():
+        xs = tf.placeholder(tf.float32, [n_steps] + list(shape))
+        outputs = []
+        with tf.variable_scope('check') as scope:
+            for t in range(n_steps):
+                if t > 0:
+                    scope.reuse_variables()
+                outputs.append(streaming.stream(xs[t], 'site'))
+        flag_up = streaming.flag_weights_updated()
+        site = streaming.streaming_sites()[0][:5]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            streamed = []
+            for i, sequence in enumerate(sequences):
+                if i > 0:
+                    sess.run(flag_up)
+                streamed.append(sess.run(outputs, feed_dict={xs: sequence}))
+            return np.array(streamed), sess.run(site)
+
+
+class StreamingTest(unittest.TestCase):
+
+    def assertClose(self, actual, expected, tolerance=1e-4):
+        self.assertLess(np.abs(np.asarray(actual) - np.asarray(expected)).max(), tolerance)
+
+    def test_unrolled_site_matches_numpy(self):
+        n_steps, shape = 28, (2, 16)
+        # races show up intermittently, so over several inputs
+        for seed in range(5):
+            rng = np.random.RandomState(seed)
+            sequences = [rng.randn(n_steps, *shape).astype(np.float32) for _ in range(3)]
+            streamed, (long_val, mean, m2, final, counter) = run_site(sequences, shape)
+
+            reference = streaming_np.StreamingStats(1, shape, dtype=np.float64)
+            for i, sequence in enumerate(sequences):
+                if i > 0:
+                    reference.mark_weights_updated()
+                expected = reference.replay(sequence[:, None], weight_update_every=0)
+                self.assertClose(streamed[i], expected[:, 0])
+            self.assertEqual(counter, reference.counter[0])
+            self.assertClose(long_val.ravel(), reference.long[0])
+            self.assertClose(mean.ravel(), reference.short[0])
+            self.assertClose(m2.ravel() / n_steps, reference.m2[0] / n_steps)
+            self.assertClose(final.ravel(), reference.final[0])
+
+    def test_fused_sn_matches_separate_sites(self):
+        n_steps, batch, n = 6, 8, 5
+        rng = np.random.RandomState(0)
+        sequences = [(rng.randn(n_steps, batch, n) * 2 + 1).astype(np.float32) for _ in range(3)]
+        # the gradient side is driven by a fixed random upstream gradient
+        upstream = rng.randn(n_steps, batch, n).astype(np.float32)
+        with tf.Graph().as_default():
+            xs = tf.placeholder(tf.float32, [n_steps, batch, n])
+            scale = tf.constant(rng.rand(n).astype(np.float32) + 0.5)
+            shift = tf.constant(rng.randn(n).astype(np.float32))
+            results = []
+            for fused in (True, False):
+                with tf.variable_scope('fused' if fused else 'separate') as scope:
+                    outputs = []
+                    for t in range(n_steps):
+                        if t > 0:
+                            scope.reuse_variables()
+                        outputs.append(layers.sn(xs[t], scale, shift, fused=fused))
+                loss = tf.add_n([tf.reduce_sum(o * upstream[t]) for t, o in enumerate(outputs)])
+                results.append(outputs + tf.gradients(loss, [xs]))
+            flag_up = streaming.flag_weights_updated()
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for i, sequence in enumerate(sequences):
+                    if i > 0:
+                        sess.run(flag_up)
+                    fused_values, separate_values = sess.run(results, feed_dict={xs: sequence})
+                    for f, s in zip(fused_values, separate_values):
+                        self.assertClose(f, s)
+
+
+if __name__ == '__main__':
+    unittest.main()